@@ -1,18 +1,22 @@
 import os
 
-from . import json2csv
-from . import gen_outline
-
 
 if __name__ == "__main__":  # pragma: no cov
     args = os.sys.argv
     prog = args[1]
     
+    # only the selected program is imported
     if prog.strip().lower() in ["gen_outline", "go", "gen", "outline"]:
+      from . import gen_outline
       gen_outline.main(args[2:])  # pragma: no cov
+    elif prog.strip().lower() in ["serve", "server"]:
+      from . import server
+      server.main(args[2:])  # pragma: no cov
     elif prog.strip().lower() in ["json2csv", "json2csv-py3", "j2c"]:
+      from . import json2csv
       json2csv.main(args[2:])  # pragma: no cov
     else:
+      from . import json2csv
       json2csv.main(args[1:])  # pragma: no cov
     
       
\ No newline at end of file
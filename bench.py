@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Benchmark the conversion hot paths of json2csv on synthetic datasets.
+
+Usage example:
+    python bench.py --rows 100000 --columns 50 --depth 3 --sparsity 0.3 -o bench.json
+    # later, after some changes
+    python bench.py --rows 100000 --columns 50 --depth 3 --sparsity 0.3 --compare bench.json
+    # import time of the CLI, failing past 50 ms
+    python bench.py --startup --max-import-ms 50
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+try:
+    from . import json2csv
+except ImportError:
+    import json2csv
+
+
+VALUE_MAKERS = [
+    lambda rng, i: i,
+    lambda rng, i: rng.random() * 1000,
+    lambda rng, i: "value %d" % rng.randint(0, 10 ** 6),
+    lambda rng, i: rng.random() < 0.5,
+    lambda rng, i: None,
+    lambda rng, i: "",
+    lambda rng, i: [rng.randint(0, 100) for _ in range(rng.randint(0, 4))],
+]
+
+
+def generate_record(i, columns, depth, sparsity, rng):
+    """A record with `columns` leaves nested `depth` levels deep. Each leaf is
+    missing with a probability of `sparsity`, like in different_keys_per_row.json
+    """
+    record = {}
+    for c in range(columns):
+        if sparsity and rng.random() < sparsity:
+            continue
+        node = record
+        for level in range(1, depth):
+            node = node.setdefault("f%d" % c if level == 1 else "l%d" % level, {})
+        node["f%d" % c if depth <= 1 else "l%d" % depth] = VALUE_MAKERS[c % len(VALUE_MAKERS)](rng, i)
+    return record
+
+
+def keypath(column, depth):
+    return ".".join(["f%d" % column] + ["l%d" % level for level in range(2, depth + 1)])
+
+
+def generate_dataset(path, rows, columns, depth, sparsity, each_line=False, seed=0):
+    """Write a synthetic dataset and return the matching outline"""
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        if each_line:
+            for i in range(rows):
+                f.write(json.dumps(generate_record(i, columns, depth, sparsity, rng)))
+                f.write("\n")
+        else:
+            f.write('{"nodes": [\n')
+            for i in range(rows):
+                f.write(("" if i == 0 else ",\n") + json.dumps(generate_record(i, columns, depth, sparsity, rng)))
+            f.write("\n]}")
+
+    outline = {
+        "map": [["col%d" % c, keypath(c, depth)] for c in range(columns)],
+        "special-values-mapping": {"null": "", "empty": "", "true": "true", "false": "false"},
+    }
+    if not each_line:
+        outline["collection"] = "nodes"
+    return outline
+
+
+def add_jq_scripts(outline):
+    outline = dict(outline)
+    outline["pre-processing"] = "map(. + {extra: 1})"
+    outline["map-processing"] = "{row: $__row__}"
+    outline["post-processing"] = "map(del(.extra))"
+    return outline
+
+
+class Timer(object):
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings[self.stage] = time.perf_counter() - self.start
+
+
+def run_stages(data_path, outline, each_line=False):
+    """Run each stage of a conversion separately and return their durations"""
+    timings = OrderedDict()
+    without_jq = {key: value for key, value in outline.items()
+                  if key not in ("pre-processing", "map-processing", "post-processing")}
+    use_jq = json2csv.jqp is not None and len(without_jq) < len(outline)
+
+    with Timer(timings, "parse"):
+        with open(data_path) as f:
+            data = [json.loads(line) for line in f] if each_line else json.load(f)
+
+    # lines are parsed in the "parse" stage: the items are mapped like the
+    # elements of a collection
+    loader = json2csv.Json2Csv(without_jq)
+    data = loader._target_data(data)
+
+    if use_jq and outline.get("pre-processing"):
+        with Timer(timings, "pre-processing"):
+            context = {"aux": {"_file_": data_path}}
+            json2csv.compile_jq(outline["pre-processing"], context).one(data)
+
+    with Timer(timings, "process_row"):
+        rows = list(loader.iter_rows(data))
+
+    if use_jq and outline.get("map-processing"):
+        jq_loader = json2csv.Json2Csv(dict(without_jq, **{"map-processing": outline["map-processing"]}))
+        with Timer(timings, "map-processing"):
+            list(jq_loader.iter_rows(data))
+        timings["map-processing"] = max(timings["map-processing"] - timings["process_row"], 0.0)
+
+    if use_jq and outline.get("post-processing"):
+        with Timer(timings, "post-processing"):
+            json2csv.compile_jq(outline["post-processing"], {"aux": {"_file_": data_path}}).one(rows)
+
+    replace_special_values = loader._special_values_replacer()
+    with Timer(timings, "special-values"):
+        for row in rows:
+            replace_special_values(row)
+
+    loader.rows = rows
+    with Timer(timings, "make_strings"):
+        loader.rows = loader.make_strings()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with Timer(timings, "write_csv"):
+            loader.write_csv(os.path.join(tmpdir, "bench.csv"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return timings, len(rows)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(rows, columns, depth, sparsity, each_line=False, jq=False, repeat=3, seed=0):
+    """Generate a dataset and time each stage, keeping the best of `repeat` runs"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmpdir, "data.ndjson" if each_line else "data.json")
+        outline = generate_dataset(data_path, rows, columns, depth, sparsity, each_line, seed)
+        if jq:
+            outline = add_jq_scripts(outline)
+        size_mb = os.path.getsize(data_path) / (1 << 20)
+
+        best = None
+        for _ in range(max(repeat, 1)):
+            timings, row_count = run_stages(data_path, outline, each_line)
+            best = timings if best is None else OrderedDict((k, min(v, timings[k])) for k, v in best.items())
+    finally:
+        shutil.rmtree(tmpdir)
+
+    stages = OrderedDict()
+    for stage, seconds in best.items():
+        stages[stage] = {
+            "seconds": round(seconds, 6),
+            "rows_per_s": round(row_count / seconds) if seconds > 0 else None,
+            "mb_per_s": round(size_mb / seconds, 2) if seconds > 0 else None,
+        }
+    total = sum(best.values())
+    return OrderedDict([
+        ("commit", git_commit()),
+        ("python", platform.python_version()),
+        ("parameters", {"rows": rows, "columns": columns, "depth": depth, "sparsity": sparsity,
+                        "each_line": each_line, "jq": jq, "repeat": repeat, "seed": seed}),
+        ("input_mb", round(size_mb, 3)),
+        ("stages", stages),
+        ("total", {"seconds": round(total, 6), "rows_per_s": round(row_count / total) if total > 0 else None,
+                   "mb_per_s": round(size_mb / total, 2) if total > 0 else None}),
+        ("peak_rss_mb", round(peak_rss_mb(), 1)),
+    ])
+
+
+def parse_importtime(output):
+    """(module, self µs, cumulative µs) of each line of `python -X importtime`"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def startup_benchmark(module="json2csv", repeat=5, top=10):
+    """Time `import module` in new interpreters, keeping the best of `repeat`
+    runs, along with the slowest imports reported by `python -X importtime`
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], cwd=cwd, check=True)
+        interpreter_s = time.perf_counter() - start
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=cwd,
+                                 stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        wall_s = time.perf_counter() - start
+        imports = parse_importtime(process.stderr)
+        import_us = next(cumulative for name, _, cumulative in imports if name == module)
+        if best is None or import_us < best[0]:
+            best = (import_us, wall_s, interpreter_s, imports)
+    import_us, wall_s, interpreter_s, imports = best
+    return OrderedDict([
+        ("commit", git_commit()),
+        ("python", platform.python_version()),
+        ("module", module),
+        ("import_ms", round(import_us / 1000.0, 2)),
+        ("wall_ms", round(wall_s * 1000, 2)),
+        ("interpreter_ms", round(interpreter_s * 1000, 2)),
+        ("modules", len(imports)),
+        ("slowest", [[name, round(self_us / 1000.0, 2)] for name, self_us, _ in sorted(imports, key=lambda i: -i[1])[:top]]),
+    ])
+
+
+def print_startup_report(results, previous=None):
+    comparison = ""
+    if previous and previous.get("import_ms"):
+        comparison = "   x{:.2f} vs previous".format(results["import_ms"] / previous["import_ms"])
+    print("import {}: {} ms, {} modules (commit {}, python {}){}".format(
+        results["module"], results["import_ms"], results["modules"], results["commit"], results["python"], comparison))
+    print("process: {} ms, of which {} ms for an empty interpreter".format(results["wall_ms"], results["interpreter_ms"]))
+    print("slowest imports (self time):")
+    for name, ms in results["slowest"]:
+        print("  {:<40}{:>8.2f} ms".format(name, ms))
+
+
+def print_report(results, previous=None):
+    print("{} rows, {:.2f} MB (commit {}, python {})".format(
+        results["parameters"]["rows"], results["input_mb"], results["commit"], results["python"]))
+    print("{:<18}{:>12}{:>14}{:>10}{}".format("stage", "seconds", "rows/s", "MB/s", "   vs previous" if previous else ""))
+    lines = list(results["stages"].items()) + [("total", results["total"])]
+    for stage, result in lines:
+        comparison = ""
+        if previous:
+            old = previous["stages"].get(stage) if stage != "total" else previous["total"]
+            if old and old["seconds"]:
+                comparison = "   x{:.2f}".format(result["seconds"] / old["seconds"])
+        print("{:<18}{:>12.4f}{:>14}{:>10}{}".format(stage, result["seconds"], result["rows_per_s"], result["mb_per_s"], comparison))
+    print("peak RSS: {} MB".format(results["peak_rss_mb"]))
+
+
+def init_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark json2csv conversion stages on a synthetic dataset")
+    parser.add_argument('--rows', type=int, default=100000, help="Number of records")
+    parser.add_argument('--columns', type=int, default=20, help="Number of leaf values per record (and columns in the outline)")
+    parser.add_argument('--depth', type=int, default=2, help="Nesting depth of each value")
+    parser.add_argument('--sparsity', type=float, default=0.0, help="Probability for a value to be missing from a record")
+    parser.add_argument('-e', '--each-line', action="store_true", help="Benchmark line-delimited input")
+    parser.add_argument('--jq', action="store_true", help="Add pre-, map- and post-processing jq scripts (needs pyjq)")
+    parser.add_argument('--repeat', type=int, default=3, help="Keep the best of this many runs")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the dataset generator")
+    parser.add_argument('--startup', action="store_true",
+        help="Benchmark the import time of json2csv in new interpreters instead of the conversion")
+    parser.add_argument('--max-import-ms', dest="max_import_ms", type=float, default=None,
+        help="With --startup, exit with an error when the import takes longer than this")
+    parser.add_argument('-o', '--output', help="Save the results as JSON to this file")
+    parser.add_argument('--compare', help="Results file of a previous run to compare with")
+    return parser
+
+
+def main(args=None):
+    parser = init_parser()
+    args = parser.parse_args(args)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    if args.startup:
+        results = startup_benchmark(repeat=args.repeat)
+        print_startup_report(results, previous)
+    else:
+        results = benchmark(args.rows, args.columns, args.depth, args.sparsity, args.each_line, args.jq, args.repeat, args.seed)
+        print_report(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.startup and args.max_import_ms is not None and results["import_ms"] > args.max_import_ms:
+        sys.exit("Importing {} took {} ms, more than {} ms".format(results["module"], results["import_ms"], args.max_import_ms))
+
+
+if __name__ == '__main__':
+    main()
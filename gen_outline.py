@@ -1,97 +1,235 @@
 #!/usr/bin/env python
 
+import bisect
+import itertools
 import json
+import math
 import os, os.path
 import operator
+import random
 
 from collections import OrderedDict
-from functools import reduce
 
 try:
-    from jsmin import jsmin
-except ModuleNotFoundError:
-    print('jsmin is not installed. Hence comments in outline file are disabled. Run "pip install jsmin" to install it')
-    jsmin = lambda x: x
-
-
-def key_paths(d):
-    def helper(path, x):
-        if isinstance(x, dict):
-            for k, v in x.items():
-                for ret in helper(path + [k], v):
-                    yield ret
-        elif isinstance(x, list):
-            for i, item in enumerate(x):
-                for ret in helper(path + [i], item):
-                    yield ret
+    from . import jsonio, outlines
+except ImportError:
+    import jsonio
+    import outlines
+
+
+# smallest range of bytes gathered by a worker
+MIN_WORKER_CHUNK = 1 << 20
+
+
+def key_paths(d, max_array_index=None, array_wildcard=False):
+    """Yield the path of each leaf of `d` as a tuple of keys and list
+    indices, depth first.
+
+    Nested values are walked with a stack of iterators instead of recursive
+    generators, and a path is only built for the leaves and the containers.
+
+    :param int max_array_index: only walk the elements of the lists up to
+                                this index
+    :param bool array_wildcard: use the wildcard key instead of the index of
+                                each element, so that the elements of a list
+                                share their paths
+    """
+    def list_children(value):
+        if max_array_index is not None:
+            value = itertools.islice(value, max_array_index + 1)
+        return zip(itertools.repeat(jsonio.WILDCARD), value) if array_wildcard else enumerate(value)
+
+    if not isinstance(d, (dict, list)):
+        yield ()
+        return
+    stack = [((), iter(d.items()) if isinstance(d, dict) else list_children(d))]
+    while stack:
+        prefix, children = stack[-1]
+        for key, value in children:
+            if isinstance(value, dict):
+                stack.append((prefix + (key,), iter(value.items())))
+                break
+            if isinstance(value, list):
+                stack.append((prefix + (key,), list_children(value)))
+                break
+            yield prefix + (key,)
         else:
-            yield path
-    return helper([], d)
+            stack.pop()
 
-def line_iter(f):
-    for line in f:
-        yield json.loads(line)
+def line_iter(f, json_backend="auto", indices=None):
+    return jsonio.iter_lines(f, jsonio.get_loads(json_backend), indices)
 
 def coll_iter(f, coll_key):
-    data = json.load(f)
-    if coll_key in data:
-        data = data[coll_key]
-    elif coll_key[0] == ".":
-        data = get_for_keypath(data, coll_key)
-    
-    for obj in data:
-        yield obj
+    return jsonio.iter_collection(f, coll_key)
 
 
 def dropkey_iter(f):
-    data = json.load(f)
-    for obj in (data.values() if isinstance(data, dict) else data):
-        yield obj
+    return jsonio.iter_collection(f, drop_root_keys=True)
 
 
-def get_for_keypath(data, keypath):
-    if keypath:
-        keys = keypath.split(".")
-        keys = keys if keys[0] else keys[1:] 
-        result = reduce(operator.getitem, keys, data)
-    else:
-        result = None
-    return result
+def item_selector(json_file, each_line, collection_key, json_backend="auto"):
+    """Function returning an iterator over the items of the input, or only
+    over the ones at the increasing indices it is given.
+    Lines that are not selected are not decoded.
+    """
+    if each_line:
+        return lambda indices=None: line_iter(json_file, json_backend, indices)
+    items = coll_iter(json_file, collection_key) if collection_key else dropkey_iter(json_file)
+    return lambda indices=None: items if indices is None else jsonio.pick(items, indices)
+
+
+def _uniform(rng):
+    """Random float in (0, 1]"""
+    return 1.0 - rng.random()
+
+
+def reservoir_indices(size, rng):
+    """Yield the index of each item entering a reservoir of `size` items,
+    with the slot of the reservoir it takes (Algorithm L). The gaps between
+    the indices are drawn: the items in between are never looked at.
+    """
+    for i in range(size):
+        yield i, i
+    if size <= 0:
+        return
+    index = size - 1
+    w = math.exp(math.log(_uniform(rng)) / size)
+    while True:
+        index += (int(math.log(_uniform(rng)) / math.log1p(-w)) if w < 1.0 else 0) + 1
+        yield index, rng.randrange(size)
+        w *= math.exp(math.log(_uniform(rng)) / size)
+
+
+def rate_indices(rate, rng):
+    """Yield increasing indices, each one with a probability of `rate`"""
+    if rate >= 1:
+        yield from itertools.count()
+        return
+    if rate <= 0:
+        return
+    log_rate = math.log1p(-rate)
+    index = -1
+    while True:
+        index += int(math.log(_uniform(rng)) / log_rate) + 1
+        yield index
+
+
+def reservoir_sample(select, size, rng):
+    """Uniform sample of `size` items as a list of (index, item) in the
+    original order
+    :param select: function returning the items at the indices it is given
+    """
+    plan, indices = itertools.tee(reservoir_indices(size, rng))
+    reservoir = []
+    for (index, slot), item in zip(plan, select(index for index, _ in indices)):
+        if slot == len(reservoir):
+            reservoir.append((index, item))
+        else:
+            reservoir[slot] = (index, item)
+    reservoir.sort(key=operator.itemgetter(0))
+    return reservoir
+
+
+def sample_items(select, size=None, rate=None, seed=None):
+    """Items sampled in their original order: `size` items taken uniformly
+    (reservoir sampling), or else each item with a probability of `rate`.
+    :param select: function returning the items at the indices it is given
+    """
+    rng = random.Random(seed)
+    if size is None:
+        return select(rate_indices(rate, rng))
+    return [item for _, item in reservoir_sample(select, size, rng)]
 
 
-def gather_key_map(iterator):
+def gather_key_map(iterator, max_array_index=None, array_wildcard=False):
     key_map = {}
     for d in iterator:
-        for path in key_paths(d):
-            key_map[tuple(path)] = True
+        for path in key_paths(d, max_array_index, array_wildcard):
+            key_map[path] = True
     return key_map
 
+
+def merge_key_maps(key_maps):
+    """Union of key maps gathered from consecutive parts of the items. Keys
+    come in the order they would have been gathered from all the items.
+    """
+    merged = {}
+    for key_map in key_maps:
+        merged.update(key_map)
+    return merged
+
+
+def gather_key_map_parallel(filepath, encoding, workers, json_backend="auto", sample=None, sample_rate=None, seed=None,
+                            max_array_index=None, array_wildcard=False, min_chunk=MIN_WORKER_CHUNK):
+    """Gather the keys of a line-delimited file in a pool of processes, each
+    one reading ranges of lines. With `sample`, each range is sampled then
+    items are drawn from the partial samples according to the number of
+    lines of each range, which is a uniform sample of the whole file.
+    """
+    ranges = jsonio.line_aligned_ranges(filepath, workers * 4, min_chunk)
+    tasks = [(filepath, start, end, encoding, json_backend, sample, sample_rate, None if seed is None else "{}-{}".format(seed, i),
+              max_array_index, array_wildcard)
+             for i, (start, end) in enumerate(ranges)]
+    import multiprocessing
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(_gather_line_range, tasks)
+    if sample is None:
+        return merge_key_maps(results)
+
+    rng = random.Random(seed)
+    counts = [count for count, _ in results]
+    ends = list(itertools.accumulate(counts))
+    drawn = [0] * len(results)
+    for i in rng.sample(range(ends[-1] if ends else 0), min(sample, sum(counts))):
+        drawn[bisect.bisect_right(ends, i)] += 1
+    key_maps = []
+    for (_, reservoir), size in zip(results, drawn):
+        items = sorted(rng.sample(reservoir, size), key=operator.itemgetter(0))
+        key_maps.append(gather_key_map((item for _, item in items), max_array_index, array_wildcard))
+    return merge_key_maps(key_maps)
+
+
+def _gather_line_range(task):
+    """Key map of a range of lines, or its line count and sample when sampling"""
+    filepath, start, end, encoding, json_backend, sample, sample_rate, seed, max_array_index, array_wildcard = task
+    lines = jsonio.MappedLines(filepath, start, end, encoding)
+    select = lambda indices=None: line_iter(lines, json_backend, indices)
+    if sample is not None:
+        return lines.count_lines(), reservoir_sample(select, sample, random.Random(seed))
+    items = select() if sample_rate is None else sample_items(select, rate=sample_rate, seed=seed)
+    return gather_key_map(items, max_array_index, array_wildcard)
+
 def path_join(path, sep='.'):
     return sep.join(str(k) for k in path)
 
+def _sort_key(path):
+    # list indices come before the keys of dictionaries found at the same level
+    return tuple((isinstance(k, str), k) for k in path)
+
+
 def key_map_to_list(key_map, should_sort=False, dummy_jq=False, no_duplicate_accessors=False):
     # We convert to strings *after* sorting so that array indices come out
     # in the correct order.
     def make_jq_selector(k):
-        components = [("[{}]".format(c) if str(c).isdigit() else c) for c in k]
-        sel = {"jq": ("." + path_join(components)), "args": {}}
+        components = [("[{}]".format(c) if str(c).isdigit() else "[]" if c == jsonio.WILDCARD else c) for c in k]
+        jq = "." + path_join(components)
+        sel = {"jq": ("[{}]".format(jq) if jsonio.WILDCARD in k else jq), "args": {}}
         return sel
     
     def group_by(collection, func):
-        groups = reduce((lambda acc,val: acc + [(func(val), [])]), collection, [])
-        from collections import OrderedDict
-        groups = OrderedDict(groups)
-        _ = [groups[func(value)].append(value) for value in collection]
+        groups = OrderedDict()
+        for value in collection:
+            groups.setdefault(func(value), []).append(value)
         return groups
 
     def group_collection_elements_in_list(collection, func):
         groups = group_by(collection, func)
-        return reduce((lambda acc, key: acc + groups[key]), groups.keys(), [])
+        return list(itertools.chain.from_iterable(groups.values()))
     
     
-    base = list(sorted(key_map.keys()) if should_sort else key_map.keys())
+    base = list(sorted(key_map.keys(), key=_sort_key) if should_sort else key_map.keys())
     if not should_sort:
-        base = group_collection_elements_in_list(base, lambda x: "_".join(x[0].split("_")[:2]))
+        base = group_collection_elements_in_list(base, lambda x: "_".join(str(x[0]).split("_")[:2]) if x else "")
     
     if dummy_jq:
         make_keypath = (lambda k: path_join(k)) if not dummy_jq or not no_duplicate_accessors else lambda _: None
@@ -100,15 +238,25 @@ def key_map_to_list(key_map, should_sort=False, dummy_jq=False, no_duplicate_acc
         return [(path_join(k, '_'), path_join(k)) for k in base]
 
 
-def make_outline(json_file, each_line, collection_key, sort_keys, drop_root_keys=False, special_values=True, dummy_jq=False, fieldwise_jq=False, no_duplicate_accessors=False):
-    if each_line:
-        iterator = line_iter(json_file)
-    elif collection_key:
-        iterator = coll_iter(json_file, collection_key)
+def make_outline(json_file, each_line, collection_key, sort_keys, drop_root_keys=False, special_values=True, dummy_jq=False, fieldwise_jq=False, no_duplicate_accessors=False, json_backend="auto",
+                 sample=None, sample_rate=None, seed=None, workers=1, max_array_index=None, array_wildcard=False):
+    """
+    :param int sample: only gather the keys of this many items, drawn uniformly
+    :param float sample_rate: only gather the keys of each item with this probability
+    :param seed: seed of the sampling
+    :param int workers: number of processes gathering the keys of ranges of lines of a line-delimited file
+    :param int max_array_index: only outline the elements of the lists up to this index
+    :param bool array_wildcard: outline the elements of each list as a single
+                                column with a wildcard keypath, like `tags.*`
+    """
+    if each_line and workers > 1 and jsonio.can_split_lines(json_file):
+        key_map = gather_key_map_parallel(json_file.name, json_file.encoding, workers, json_backend, sample, sample_rate, seed,
+                                          max_array_index, array_wildcard)
     else:
-        iterator = dropkey_iter(json_file)
-
-    key_map = gather_key_map(iterator)
+        select = item_selector(json_file, each_line, collection_key, json_backend)
+        sampled = sample is not None or sample_rate is not None
+        key_map = gather_key_map(sample_items(select, sample, sample_rate, seed) if sampled else select(),
+                                 max_array_index, array_wildcard)
     outline = {}
     if collection_key:
         outline['collection'] = collection_key
@@ -151,9 +299,7 @@ def mainExtractJqScripts(inputs, output, escapeQuotes, input_encoding=None, outp
         return txt
     
     def extractFromSingleFile(filepath):
-        with open(filepath, "r", encoding=input_encoding) as fh:
-            content = fh.read()
-        data = json.loads(jsmin(content))
+        data = outlines.load_outline(filepath, encoding=input_encoding)
         txt = ("#### context data available within the script\n{}\n\n\n\n"
             "#### pre-processing script\n{}\n\n\n\n"
             "#### post-processing script\n{}\n"
@@ -188,6 +334,27 @@ Usage example:
         help="Path to outline file to output. Omitting this will create a file based on the input file's path.")
     parser.add_argument('--encoding', '--input-encoding', dest="input_encoding", help="Custom encoding to use when reading input files. Especially useful on Windows since an ANSI-compatible encoding might otherwise be used.")
     parser.add_argument('--output-encoding', dest="output_encoding", help="Custom output file encoding")
+    parser.add_argument('--json-backend', dest="json_backend", default="auto", choices=jsonio.BACKENDS,
+        help="Library decoding line-delimited input. 'auto' picks simdjson or ujson if installed, else the standard 'json' module. orjson reads integers over 64 bits as floats, hence it is only used when asked for. Default is auto")
+
+    parser.add_argument('--workers', type=int, default=1,
+        help="Number of processes gathering the keys of ranges of lines of a line-delimited file (with --each-line). Default is %(default)s")
+
+    arrays_group = parser.add_argument_group("Array options", "Limit the columns made of the elements of lists")
+    arrays_group.add_argument('--max-array-index', dest="max_array_index", type=int, default=None, metavar="K",
+        help="Only outline the elements of the lists up to index K (the first K+1 elements)")
+    arrays_group.add_argument('--array-wildcard', dest="array_wildcard", action="store_true",
+        help="Outline the elements of each list as one column with a wildcard keypath, like 'tags.*' or 'items.*.id'. "
+             "json2csv writes the values found under every element of the list")
+
+    sampling_group = parser.add_argument_group("Sampling options", "Gather the keys of a part of the items only, to quickly outline large files")
+    sample_options = sampling_group.add_mutually_exclusive_group()
+    sample_options.add_argument('--sample', type=int, default=None, metavar="N",
+        help="Number of items drawn uniformly (reservoir sampling). Lines that are not drawn are not decoded")
+    sample_options.add_argument('--sample-rate', dest="sample_rate", type=float, default=None, metavar="P",
+        help="Probability for each item to be drawn, between 0 and 1")
+    sampling_group.add_argument('--seed', default=None,
+        help="Seed of the sampling, to draw the same items again")
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-e', '--each-line', action="store_true", dest="each_line",
@@ -242,6 +409,12 @@ Usage example:
 def main(args=None):
     parser = init_parser()
     args = parser.parse_args(args)
+    if args.sample is not None and args.sample < 0:
+        parser.error("--sample must be positive")
+    if args.sample_rate is not None and not 0 <= args.sample_rate <= 1:
+        parser.error("--sample-rate must be between 0 and 1")
+    if args.max_array_index is not None and args.max_array_index < 0:
+        parser.error("--max-array-index must be positive")
     
     ## option 1 
     if args.extractJq:
@@ -256,11 +429,13 @@ def main(args=None):
     for i, path in enumerate(args.filepaths):
         print("%i / %i) Processing file at %s" % (i+1, len(args.filepaths), path))
         try:
-            with open(path, "r", encoding=args.input_encoding) as filehandle:
-                outline = make_outline(filehandle, args.each_line, args.collection, args.sortKeys, args.dropRootKeys, True, args.jq_processing, args.fieldwise_jq_processing, args.no_duplicate_accessors)
+            with jsonio.open_input(path, encoding=args.input_encoding) as filehandle:
+                outline = make_outline(filehandle, args.each_line, args.collection, args.sortKeys, args.dropRootKeys, True, args.jq_processing, args.fieldwise_jq_processing, args.no_duplicate_accessors, args.json_backend,
+                                       args.sample, args.sample_rate, args.seed, args.workers,
+                                       args.max_array_index, args.array_wildcard)
                 outfile = args.output_file
                 if outfile is None:
-                    fileName, fileExtension = os.path.splitext(filehandle.name)
+                    fileName, fileExtension = os.path.splitext(jsonio.strip_compression_extension(filehandle.name))
                     outfile = fileName + '.outline.json'
 
             with open(outfile, 'w', encoding=args.output_encoding) as f:
@@ -1,35 +1,204 @@
 #!/usr/bin/env python
 
-try:
-    import unicodecsv as csv
-except ImportError:
-    import csv
-
 import json
 import operator
 import os
-import logging
-import datetime
-import glob  # Unix-like path matching
+import re
+import marshal
+import sys
+import itertools
+import time
 
 from collections import OrderedDict
-from functools import reduce
+from contextlib import contextmanager
+from functools import lru_cache, reduce
 
 try:
-    from jsmin import jsmin
-except ModuleNotFoundError:
-    print('jsmin is not installed. Hence comments in outline file are disabled. Run "pip install jsmin" to install it')
-    jsmin = lambda x: x
-
-try:
-    import pyjq as jqp  # jq-processor
-except ModuleNotFoundError:
-    jqp = None
+    from . import jsonio, writers
+except ImportError:
+    import jsonio
+    import writers
 
 
 __version__ = "0.2.3.1"
 
-logging.basicConfig(level=logging.WARNING)
+# errors meaning a keypath does not exist in an item
+_LOOKUP_ERRORS = (KeyError, IndexError, TypeError)
+
+
+def _lookup(data, keys):
+    """Value at a split keypath. A wildcard key stands for every element of a
+    list: the value is then the list of the values found under each element.
+    """
+    if jsonio.WILDCARD not in keys:
+        return reduce(operator.getitem, keys, data)
+    wildcard = keys.index(jsonio.WILDCARD)
+    elements = reduce(operator.getitem, keys[:wildcard], data)
+    if not isinstance(elements, list):
+        raise TypeError("Expecting a list for the wildcard of the keypath {}".format(keys))
+    rest = keys[wildcard + 1:]
+    values = []
+    for element in elements:
+        try:
+            values.append(_lookup(element, rest))
+        except _LOOKUP_ERRORS:
+            pass
+    return values
+
+# row fields that can be bound to jq variables
+_JQ_IDENTIFIER = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+@lru_cache(maxsize=None)
+def _import_jq():
+    """pyjq (the jq processor), imported on first use. None if it is not installed"""
+    try:
+        import pyjq
+    except ModuleNotFoundError:
+        return None
+    return pyjq
+
+
+def __getattr__(name):
+    # `jqp` is the pyjq module, only imported when asked for
+    if name == "jqp":
+        return _import_jq()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+@lru_cache(maxsize=None)
+def _is_jq_variable(name):
+    """Whether a row field can be bound to `$name` in jq scripts. The
+    keywords of the installed jq (`if`, `module`, ...) cannot
+    """
+    if not _JQ_IDENTIFIER.match(name):
+        return False
+    try:
+        _import_jq().compile(". as $%s | ." % name)
+    except Exception:
+        return False
+    return True
+
+
+def _log_warning(message):
+    # logging is slow to import and only needed on errors
+    import logging
+    logging.warning(message)
+
+
+@lru_cache(maxsize=256)
+def _compile_jq(script, variables_json):
+    return _import_jq().compile(script, vars=json.loads(variables_json))
+
+
+def compile_jq(script, variables):
+    """Compiled jq program, cached by script and variables.
+    The cache is shared by every outline of the process.
+    """
+    return _compile_jq(script, json.dumps(variables, sort_keys=True))
+
+
+class _BrokenJqProgram(object):
+    """Stands for a jq script that failed to compile.
+    Raises the compilation error when used, like calling jq would have.
+    """
+    def __init__(self, error):
+        self.error = error
+
+    def one(self, value):
+        raise self.error
+
+
+class ConversionStats(object):
+    """Wall time spent in each stage of a conversion, and counters.
+    
+    Stages run once per file are always timed. Stages run for each row are
+    only timed when profiling, to keep the overhead out of normal runs.
+    """
+    STAGES = ("parse", "pre-processing", "mapping", "map-processing", "field-wise jq",
+              "post-processing", "header", "write")
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.timings = OrderedDict((stage, 0.0) for stage in self.STAGES)
+        self.items = 0  # items mapped to a row
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.none_fields = 0  # fields whose keypath was missing in the item
+        self.jq_errors = 0
+    
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+    
+    def timed(self, stage, func):
+        """Wrap a function to add its duration to the stage"""
+        timings = self.timings
+        perf_counter = time.perf_counter
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[stage] += perf_counter() - start
+        return wrapper
+    
+    def timed_iter(self, stage, iterable):
+        """Iterate while adding the time spent producing each element to the stage"""
+        timings = self.timings
+        perf_counter = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timings[stage] += perf_counter() - start
+            yield value
+    
+    def merge(self, other):
+        """Add the timings and counters of another stats object (or its dict)"""
+        other = other if isinstance(other, dict) else other.as_dict()
+        for stage, seconds in other["timings"].items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        for counter in ("items", "rows_written", "bytes_written", "none_fields", "jq_errors"):
+            setattr(self, counter, getattr(self, counter) + other[counter])
+    
+    def as_dict(self):
+        return OrderedDict([
+            ("timings", OrderedDict(self.timings)),
+            ("items", self.items),
+            ("rows_written", self.rows_written),
+            ("bytes_written", self.bytes_written),
+            ("none_fields", self.none_fields),
+            ("jq_errors", self.jq_errors),
+        ])
+    
+    def report(self):
+        total = sum(self.timings.values())
+        lines = ["  {} items mapped, {} rows written, {} missing fields, {} jq errors".format(
+            self.items, self.rows_written, self.none_fields, self.jq_errors)]
+        for stage, seconds in self.timings.items():
+            share = (100.0 * seconds / total) if total else 0.0
+            lines.append("  {:<16}{:>10.4f}s {:>6.1f}%".format(stage, seconds, share))
+        lines.append("  {:<16}{:>10.4f}s".format("total", total))
+        write_time = self.timings["write"]
+        if self.bytes_written and write_time:
+            lines.append("  {} bytes written, {:.1f} MB/s".format(self.bytes_written, self.bytes_written / write_time / (1 << 20)))
+        return "\n".join(lines)
+    
+    def count_written(self, writer):
+        """Add the rows and bytes written by a closed writer"""
+        self.rows_written += writer.rows_written
+        self.bytes_written += writer.bytes_written or 0
+
 
 class Json2Csv(object):
     """Process a JSON object to a CSV file"""
@@ -50,8 +219,15 @@ class Json2Csv(object):
     # DICT_OPEN = '{ '
     # DICT_CLOSE = '} '
 
-    def __init__(self, outline):
+    # write lists and dictionaries as compact JSON instead
+    nested_json = False
+
+    def __init__(self, outline, profile=False, json_backend="auto"):
         self.rows = []
+        self.profile = profile
+        self.json_backend = json_backend
+        self._loads = jsonio.get_loads(json_backend)
+        self.stats = ConversionStats()
 
         if not isinstance(outline, dict):
             raise ValueError('You must pass in an outline for JSON2CSV to follow')
@@ -66,6 +242,7 @@ class Json2Csv(object):
         self.postprocessing = self._optimized_jq_selector(self.postprocessing)
         self.context_constants = outline.get('context-constants', {})
         self.special_values_mapping = outline.get('special-values-mapping', {})
+        self.map_processing_batch_size = outline.get('map-processing-batch-size', 1000)
         
         # pyjq does not support multiple root keys for the 'vars' argument
         assert not self.context_constants or len(self.context_constants) <= 1, "Expecting only 1 root key in context_constants. To use more constants, place them in a dictionary under the root key 'aux'"
@@ -82,12 +259,160 @@ class Json2Csv(object):
             key_processing_map[header] = custom_processing
 
         self.key_map = key_map
+        self._extract_row = self._compile_extractor(key_map)
         self.header_keys = OrderedDict(self.key_map)
         self.key_processing_map = key_processing_map
         if 'collection' in outline:
             self.collection = outline['collection']
         elif 'dropRootKeys' in outline:
             self.root_array = True
+        
+        # pyjq is only imported when the outline has jq scripts
+        has_scripts = self.preprocessing or self.mapprocessing or self.postprocessing or any(key_processing_map.values())
+        self.uses_jq = bool(has_scripts) and _import_jq() is not None
+        if self.uses_jq:
+            self._compile_jq_programs()
+        
+        if profile:
+            # time the per-row stages without checks in the row processing
+            self._extract_row = self.stats.timed("mapping", self._extract_row)
+            self._apply_map_processing = self.stats.timed("map-processing", self._apply_map_processing)
+            self._run_map_processing_batch = self.stats.timed("map-processing", self._run_map_processing_batch)
+            self._apply_fieldwise_jq = self.stats.timed("field-wise jq", self._apply_fieldwise_jq)
+    
+    def reset(self):
+        """Forget the rows, header and stats of the previous conversion, so
+        that the instance converts another file with the same outline
+        """
+        self.rows = []
+        self.header_keys = OrderedDict(self.key_map)
+        self.stats.reset()
+    
+    def _compile_jq_programs(self):
+        """Compile every jq script of the outline once.
+        
+        The variables that change with each row (the row fields and
+        `$__row__`) are bound from the input of the programs, so that the same
+        compiled program serves every row. Programs are cached by script and
+        constants, hence shared between the files of a multi-file run.
+        """
+        self._pre_program = self._jq_program(self.preprocessing) if self.preprocessing else None
+        self._post_program = self._jq_program(self.postprocessing) if self.postprocessing else None
+        
+        row_fields = [name for name in self.key_map.keys() if name != '__row__' and _is_jq_variable(name)]
+        self._map_var_names = [name for name in row_fields if name not in self.context_constants] + ['__row__']
+        if self.mapprocessing:
+            self._map_program = self._jq_program(self._bind_row_vars(self._map_var_names, self.mapprocessing))
+            # the script may end with a comment: close the brackets on the next line
+            self._map_batch_program = self._jq_program(
+                "[.[] | (%s)]" % self._bind_row_vars(self._map_var_names, "[%s\n]" % self.mapprocessing))
+        
+        ## The arguments of the field-wise selectors are constants. As when
+        ## calling jq for each field, the arguments of the previous fields
+        ## are available too.
+        self._fieldwise_programs = {}
+        args = {}
+        for header, data in self.key_processing_map.items():
+            if not isinstance(data, dict):
+                continue
+            args.update(data.get('args', {}))
+            selector = self._optimized_jq_selector(data.get('jq'))
+            if selector:
+                names = [name for name in self._map_var_names if name not in args]
+                program = self._jq_program(self._bind_row_vars(names, selector), args)
+                self._fieldwise_programs[header] = (names, selector, program)
+    
+    def _jq_program(self, script, extra_vars=None):
+        variables = dict(self.context_constants)
+        aux = variables.get("aux")
+        if isinstance(aux, dict) and "_file_" in aux and "$aux" not in script:
+            # the program does not depend on the file: share it between files.
+            # Scripts using $aux (even without its "_file_" key, like
+            # `$aux | keys`) get it whole
+            variables["aux"] = {key: value for key, value in aux.items() if key != "_file_"}
+        variables.update(extra_vars or {})
+        try:
+            return compile_jq(script, variables)
+        except Exception as err:
+            return _BrokenJqProgram(err)
+    
+    def _bind_row_vars(self, names, script):
+        """Script reading its input and per-row variables from an
+        `[input, {variables}]` pair
+        """
+        if not names:
+            return ".[0] | %s" % script
+        return ".[1] as {%s} | .[0] | %s" % (", ".join("$" + name for name in names), script)
+    
+    def _compile_extractor(self, key_map):
+        """Compile the keypaths of the map into a single function building a
+        row from an item.
+        
+        Keypaths are merged in a prefix tree so that a shared prefix (like
+        `source` in `source.author` and `source.date`) is walked once per
+        row, and a missing prefix skips all the keypaths below it. Headers
+        without keypath are constants and never go through exception handling.
+        Keypaths with a wildcard are walked to the wildcard, the rest is
+        looked up for each element of the list.
+        """
+        headers = list(key_map.keys())
+        # (children by key, indices of the headers ending here,
+        #  (index, keys from the wildcard) of the headers with a wildcard here)
+        tree = ({}, [], [])
+        for i, keys in enumerate(key_map.values()):
+            node = tree
+            wildcard = keys.index(jsonio.WILDCARD) if jsonio.WILDCARD in keys else len(keys)
+            for key in keys[:wildcard]:
+                node = node[0].setdefault(key, ({}, [], []))
+            if wildcard < len(keys):
+                node[2].append((i, keys[wildcard:]))
+            elif keys:
+                node[1].append(i)
+        
+        lines = ["def extract(item):"]
+        if headers:
+            lines.append("    " + " = ".join("v%d" % i for i in range(len(headers))) + " = None")
+        names = ("n%d" % i for i in itertools.count())
+        
+        def count_headers(node):
+            return len(node[1]) + len(node[2]) + sum(count_headers(child) for child in node[0].values())
+        
+        def add_lookups(node, var, indent):
+            for i, keys in node[2]:
+                lines.append(indent + "try:")
+                lines.append(indent + "    v%d = _lookup(%s, %r)" % (i, var, keys))
+                lines.append(indent + "except _LOOKUP_ERRORS:")
+                lines.append(indent + "    _stats.none_fields += 1")
+            for key, child in node[0].items():
+                name = next(names)
+                lines.append(indent + "try:")
+                lines.append(indent + "    %s = %s[%r]" % (name, var, key))
+                lines.append(indent + "except _LOOKUP_ERRORS:")
+                lines.append(indent + "    _stats.none_fields += %d" % count_headers(child))
+                lines.append(indent + "else:")
+                lines.extend(indent + "    v%d = %s" % (i, name) for i in child[1])
+                add_lookups(child, name, indent + "    ")
+        
+        add_lookups(tree, "item", "    ")
+        lines.append("    return {%s}" % ", ".join("%r: v%d" % (header, i) for i, header in enumerate(headers)))
+        
+        namespace = {"_LOOKUP_ERRORS": _LOOKUP_ERRORS, "_stats": self.stats, "_lookup": _lookup}
+        try:
+            exec(compile("\n".join(lines), "<json2csv row extractor>", "exec"), namespace)
+        except (SyntaxError, RecursionError):
+            # keypaths too deep to be compiled: use the generic lookups
+            return self._extract_row_generic
+        return namespace["extract"]
+    
+    def _extract_row_generic(self, item):
+        row = {}
+        for header, keys in self.key_map.items():
+            try:
+                row[header] = _lookup(item, keys) if keys else None
+            except _LOOKUP_ERRORS:
+                self.stats.none_fields += 1
+                row[header] = None
+        return row
     
     def _optimized_jq_selector(self, selector):
         """nullifies if the command is the identity. Against performance issue.
@@ -104,16 +429,51 @@ class Json2Csv(object):
         return cmd
 
     def load(self, json_file):
-        data = json.load(json_file)
+        data = self._load_target_data(json_file)
+        
+        ## Mapping and processing
+        rows = self.iter_rows(data)
+        
+        # special values are replaced in place, in a single pass. Rows are
+        # replaced as they are produced, unless post-processing still needs
+        # the original values
+        replace_special_values = self._special_values_replacer()
+        postprocess = self.uses_jq and self.postprocessing
+        self.rows.extend(rows if postprocess else map(replace_special_values, rows))
+        
+        # performance: avoid calling jq if identity
+        if postprocess:
+            with self.stats.timer("post-processing"):
+                self.rows = self._post_program.one(self.rows)
+        
+        with self.stats.timer("header"):
+            self._update_header_keys(self.rows)
+        if postprocess:
+            for row in self.rows:
+                replace_special_values(row)
+    
+    
+    def _load_target_data(self, json_file, incremental=False):
+        """Parse the input file and return the (pre-processed) collection of
+        items to map
+        :param bool incremental: lazily parse the items one at a time instead
+                                 of loading the whole document. Pre-processing
+                                 needs the whole collection, so it is ignored
+                                 when pre-processing is used.
+        """
+        if incremental and not (self.uses_jq and self.preprocessing):
+            data = jsonio.iter_collection(json_file, self.collection, self.root_array)
+        else:
+            with self.stats.timer("parse"):
+                data = self._target_data(jsonio.load(json_file, self._loads))
         
         ## If we wanted to allow the user to use JQ to select the keys to use
         ## we would change the order of both these lines
-        ## (... self._target_data(...) and data = jqp.one(...) ...)
+        ## (... self._target_data(...) and data = jqp.one(...) ...)
         ## 
         ## Or another behaviour you may want to allow by swapping their order
         ## is allowing the user to use keys and data outside the self.collection
-        ## attribute as part of the preprocessing. It offers more possibilities
-        data = self._target_data(data)
+        ## attribute as part of the preprocessing. It offers more possibilities
         
         if not self.context_constants:
             self.context_constants = {"aux":{"_file_": json_file.name}}
@@ -122,29 +482,43 @@ class Json2Csv(object):
             self.context_constants["aux"]["_file_"] = json_file.name    
         
         # performance: avoid calling jq if identity
-        data = jqp.one(self.preprocessing, data, vars=self.context_constants) if jqp and self.preprocessing else data
-        
-        ## Mapping and processing
-        self.process_each(data)
-        
-        # performance: avoid calling jq if identity
-        if jqp and self.postprocessing:
-            self.rows = jqp.one(self.postprocessing, self.rows, vars=self.context_constants)
-        
-        self._update_header_keys(self.rows)
-        # special values
+        if self.uses_jq:
+            self._compile_jq_programs()
+        if self.uses_jq and self.preprocessing:
+            with self.stats.timer("pre-processing"):
+                data = self._pre_program.one(data)
+        return data
+    
+    def _special_values(self):
+        """Values replacing null, empty strings, true and false in the output
+        """
         vnone = self.special_values_mapping.get("null", "")
         vempty = self.special_values_mapping.get("empty", "")
         vtrue = self.special_values_mapping.get("true", "true")
         vfalse = self.special_values_mapping.get("false", "false")
+        return vnone, vempty, vtrue, vfalse
+    
+    def _special_values_replacer(self):
+        """Build a function replacing the special values of a row in place.
+        The replacements are simultaneous, as described in the README.
+        """
+        vnone, vempty, vtrue, vfalse = self._special_values()
+        vnone = vnone if vnone is not None else ""
+        vempty = vempty if vempty is not None else ""
+        
+        def replace_special_values(row):
+            for key, value in row.items():
+                if value is None:
+                    row[key] = vnone
+                elif value is True:
+                    row[key] = vtrue
+                elif value is False:
+                    row[key] = vfalse
+                elif value == "":
+                    row[key] = vempty
+            return row
         
-        # a tad faster than the 2 calls equivalent
-        # however, replace it if needed for maintenance
-        self.rows = self._replace_nulls(self.rows, vnone, vempty)
-        # self.rows = self._replace_value(self.rows, None, vnone, by_identity=True)
-        # self.rows = self._replace_value(self.rows, "", vempty, by_identity=False)
-        self.rows = self._replace_value(self.rows, True, vtrue, by_identity=True)
-        self.rows = self._replace_value(self.rows, False, vfalse, by_identity=True)
+        return replace_special_values
     
     
     def _update_header_keys(self, data_rows):
@@ -152,49 +526,32 @@ class Json2Csv(object):
         ## actually added to the CSV
         ## Ensure the keys that were removed by a dynamic processing step like
         ## JQ are also removed. This can allow the user to have temporary
-        ## helper fields and clean them in post-processing
-        every_keys = OrderedDict()
-        on_single_row = lambda acc, row_dict: every_keys.update({key:None for key in row_dict.keys()}) or every_keys
-        _ = reduce(on_single_row, data_rows, every_keys)
+        ## helper fields and clean them in post-processing
+        if not data_rows:
+            self.header_keys = OrderedDict()
+            return
         
-        initial_keys = set(self.header_keys.keys())
-        found_keys = set(every_keys.keys())  # keys found in rows. we will see those
+        if not (self.uses_jq and self.postprocessing):
+            # rows have every key of the map, and the keys added by
+            # map-processing were tracked while mapping: no need to look at
+            # each row again
+            self.header_keys = OrderedDict.fromkeys(self.header_keys)
+            return
         
-        # keys_to_add = set(found_keys) - set(initial_keys)
-        keys_to_remove = set(initial_keys) - set(found_keys)
-        # difference_symmetrique = keys_to_add.union(keys_to_remove)
+        # keys found in rows, in the order they are first seen. Most rows
+        # have no new key: check that first, without looping in Python
+        every_keys = OrderedDict()
+        found = every_keys.keys()
+        for row in data_rows:
+            if not row.keys() <= found:
+                for key in row:
+                    if key not in every_keys:
+                        every_keys[key] = None
         
         # only adds new keys at the end without messing the existing order
-        self.header_keys.update(every_keys)
-        
-        _ = [self.header_keys.pop(key) for key in keys_to_remove]
-        pass
-    
-    def _replace_value(self, data, target, new_value, by_identity):
-        """Replace a value
-        :param data: rows (list of dicts)
-        :param target: value to look for and try to replace
-        :param new_value: value to replace with
-        :param bool by_identity: compare by identity (if True, compares with the "is" operator), or by equality (with "==" operator)
-        """
-        f_replace_by_identity = lambda to_replace, old, value_for: old if (old is not to_replace) else value_for
-        f_replace_by_equality = lambda to_replace, old, value_for: old if (old != to_replace) else value_for
-        
-        f_replace_ref = f_replace_by_identity if by_identity else f_replace_by_equality
-        
-        f_on_row = lambda row: {key: f_replace_ref(target, orig_val, new_value) for key, orig_val in row.items()}
-        transformed = list(map(f_on_row, data))
-        return transformed
-    
-    
-    def _replace_nulls(self, data, value_for_none=None, value_for_empty=None):
-        value_for_none = value_for_none if value_for_none is not None else ""
-        value_for_empty = value_for_empty if value_for_empty is not None else ""
-        
-        f_replace = lambda x: x if (x is not None and x != "") else (value_for_none if x is None else value_for_empty)
-        transformed = list(map(lambda row: {key: f_replace(value) for key, value in row.items()}, data))
-        return transformed
-    
+        header_keys = OrderedDict((key, None) for key in self.header_keys if key in every_keys)
+        header_keys.update(every_keys)
+        self.header_keys = header_keys
     
     def _target_data(self, data):
         if self.collection:
@@ -211,24 +568,37 @@ class Json2Csv(object):
         """Process each item of a json-loaded dict
         """
         # data = self._target_data(data)  # already done in self.load(..)
+        self.rows.extend(self.iter_rows(data))
+
+    def iter_rows(self, data, start=0):
+        """Lazily map each item of the collection to a row
+        :param int start: index of the first item
+        """
+        entries = self._iter_entries(data)
+        if self.profile:
+            entries = self.stats.timed_iter("parse", entries)
+        entries = enumerate(entries, start)
+        stats = self.stats
+        if self.uses_jq and self.mapprocessing and self.map_processing_batch_size > 1:
+            while True:
+                batch = list(itertools.islice(entries, self.map_processing_batch_size))
+                if not batch:
+                    return
+                stats.items += len(batch)
+                for row in self.process_rows(batch):
+                    yield row
         
-        for i, entry in enumerate(data):
-            logging.info(entry)
-            self.rows.append(self.process_row(entry, i))
+        for i, entry in entries:
+            stats.items += 1
+            yield self.process_row(entry, i)
+
+    def _iter_entries(self, data):
+        return iter(data)
 
     def process_row(self, item, index):
         """Process a row of json data against the key map
         """
-        row = {}
-
-        for header, keys in self.key_map.items():
-            try:
-                if keys:
-                    row[header] = reduce(operator.getitem, keys, item)
-                else:
-                    row[header] = None
-            except (KeyError, IndexError, TypeError):
-                row[header] = None
+        row = self._extract_row(item)
 
         
         ######   Map-processing   row-wise   ######
@@ -236,18 +606,82 @@ class Json2Csv(object):
         ### than field-wise selectors).
         
         # to make custom generated fields available in JQ as $myvar
-        jq_params = row.copy()
-        jq_params.update(self.context_constants)
-        jq_params.update({'__row__': index})
+        jq_params = self._jq_params(row, index)
         if self.mapprocessing:
-            try:
-                computed = jqp.one(self.mapprocessing, item, vars=jq_params)
-                row.update(computed)
-                self.header_keys.update({key: None for key in computed.keys()})
-            except Exception as err:
-                logging.warning(" JQ Error with map-processing JQ script '{}'. Error text: {}".format(self.mapprocessing, err))
+            self._apply_map_processing(item, row, jq_params)
+        
+        self._apply_fieldwise_jq(item, row, jq_params)
+        return row
+
+    def process_rows(self, indexed_items):
+        """Process a batch of (index, item) pairs.
+        The items go through map-processing in a single jq call, which is much
+        faster than one call per row. The rows are the same as the ones of
+        `process_row`.
+        """
+        rows = [self._extract_row(item) for _, item in indexed_items]
+        params = [self._jq_params(row, index) for (index, _), row in zip(indexed_items, rows)]
         
+        try:
+            results = self._run_map_processing_batch(indexed_items, rows)
+        except Exception:
+            # a jq error aborts the whole batch: process the rows one by one to
+            # only lose the faulty ones
+            results = None
         
+        for i, ((_, item), row) in enumerate(zip(indexed_items, rows)):
+            if results is None:
+                self._apply_map_processing(item, row, params[i])
+            else:
+                try:
+                    if len(results[i]) != 1:
+                        raise IndexError("Result of jq is empty" if not results[i] else "Result of jq have multiple elements")
+                    self._merge_computed(row, results[i][0])
+                except Exception as err:
+                    self._map_processing_error(err)
+            self._apply_fieldwise_jq(item, row, params[i])
+        return rows
+
+    def _jq_params(self, row, index):
+        jq_params = row.copy()
+        jq_params.update(self.context_constants)
+        jq_params.update({'__row__': index})
+        return jq_params
+
+    def _apply_map_processing(self, item, row, jq_params):
+        try:
+            computed = self._map_program.one([item, {name: jq_params[name] for name in self._map_var_names}])
+            self._merge_computed(row, computed)
+        except Exception as err:
+            self._map_processing_error(err)
+
+    def _merge_computed(self, row, computed):
+        row.update(computed)
+        header_keys = self.header_keys
+        if not computed.keys() <= header_keys.keys():
+            for key in computed:
+                if key not in header_keys:
+                    header_keys[key] = None
+
+    def _map_processing_error(self, err):
+        self.stats.jq_errors += 1
+        _log_warning(" JQ Error with map-processing JQ script '{}'. Error text: {}".format(self.mapprocessing, err))
+
+    def _run_map_processing_batch(self, indexed_items, rows):
+        """Run map-processing on every item at once.
+        Each element of the input holds an item and the row fields that
+        `process_row` passes as jq variables.
+        Returns the list of the results of each item.
+        """
+        names = self._map_var_names
+        batch = []
+        for (index, item), row in zip(indexed_items, rows):
+            variables = {name: row[name] for name in names[:-1]}
+            variables['__row__'] = index
+            batch.append([item, variables])
+        return self._map_batch_program.one(batch)
+
+    def _apply_fieldwise_jq(self, item, row, jq_params):
         ######   Individual field-wise JQ selectors   ######
         ### Note: The user should rely mostly on row-wise map-processing
         ###       instead of these field-wise calls. This is left here for
@@ -263,62 +697,186 @@ class Json2Csv(object):
         ### calls unless there is no other choice.
         
         for header, data in self.key_processing_map.items():
-            if jqp and row[header] is None and data is not None:  # row[header] is None:
+            if self.uses_jq and row[header] is None and header in self._fieldwise_programs:
+                ## NOTE: the arguments of the previous selectors are also
+                ## available. However it's fine we let user be smart about
+                ## their selector scripts. Internals should not be abused.
+                names, selector, program = self._fieldwise_programs[header]
                 try:
-                    selector = data.get('jq')
-                    args = data.get('args', {})
-                    ## NOTE: this causes more variables to be available than
-                    ## should be. However it's fine we let user be smart about
-                    ## their selector scripts. Internals should not be abused.
-                    ## Avoid performance hits
-                    jq_params.update(args)
-                    
-                    selector = self._optimized_jq_selector(selector)
-                    if selector:
-                        try:
-                            tmp = jqp.one(selector, item, vars=jq_params)
-                        except Exception as err:
-                            logging.warning("Error on key '{}' with JQ '{}'. Error text: {}".format(header, selector, err))
-                            tmp = None
-                        
-                        row[header] = tmp
-                except (KeyError, IndexError, TypeError, ValueError):
-                    pass
-
-        return row
+                    tmp = program.one([item, {name: jq_params[name] for name in names}])
+                except Exception as err:
+                    self.stats.jq_errors += 1
+                    _log_warning("Error on key '{}' with JQ '{}'. Error text: {}".format(header, selector, err))
+                    tmp = None
+                
+                row[header] = tmp
 
     def make_strings(self):
-        str_rows = []
-        for row in self.rows:
-            str_rows.append({k: self.make_string(val)
-                             for k, val in list(row.items())})
-        return str_rows
+        convert_row = self._row_string_converter()
+        return [convert_row(row) for row in self.rows]
 
     def make_string(self, item):
-        if isinstance(item, list) or isinstance(item, set) or isinstance(item, tuple):
-            return self.SEP_CHAR.join([self.make_string(subitem) for subitem in item])
-        elif isinstance(item, dict):
-            return self.DICT_OPEN + self.DICT_SEP_CHAR.join([self.KEY_VAL_CHAR.join([k, self.make_string(val)]) for k, val in list(item.items())]) + self.DICT_CLOSE
+        return self._string_converter()(item)
+
+    def _string_converter(self):
+        """Return a function converting a value to the string written in the
+        CSV. The conversion is picked from the exact type of the value, and
+        strings are returned as they are.
+        """
+        sep, key_val, dict_sep = self.SEP_CHAR, self.KEY_VAL_CHAR, self.DICT_SEP_CHAR
+        dict_open, dict_close = self.DICT_OPEN, self.DICT_CLOSE
+        
+        if self.nested_json:
+            encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False,
+                                      default=lambda o: list(o) if isinstance(o, (set, frozenset)) else str(o)).encode
+            join_sequence = join_dict = encode
         else:
-            return str(item)
+            def join_sequence(item):
+                if scalar_classes.issuperset(map(type, item)):
+                    # scalars only: str() is their conversion
+                    return sep.join(map(str, item))
+                return sep.join([convert(subitem) for subitem in item])
+            
+            def join_dict(item):
+                return dict_open + dict_sep.join([k + key_val + convert(val) for k, val in item.items()]) + dict_close
+        
+        dispatch = {int: str, float: str, bool: str, type(None): str,
+                    list: join_sequence, tuple: join_sequence, set: join_sequence, dict: join_dict}
+        nested_types = ((list, join_sequence), (set, join_sequence), (tuple, join_sequence), (dict, join_dict))
+        scalar_classes = {str, int, float, bool, type(None)}
+        
+        def convert(item):
+            cls = type(item)
+            if cls is str:
+                return item
+            func = dispatch.get(cls)
+            if func is None:
+                # subclasses like OrderedDict: find the conversion once
+                func = next((f for base, f in nested_types if isinstance(item, base)), str)
+                dispatch[cls] = func
+            return func(item)
+        return convert
+
+    def _row_string_converter(self):
+        convert = self._string_converter()
+        return lambda row: {k: convert(val) for k, val in row.items()}
 
     def write_csv(self, filename='output.csv', make_strings=False, write_header=True, delimiter=",", allow_empty=False, output_encoding=None):
         """Write the processed rows to the given filename
         """
+        self.write_output(filename, "csv", make_strings, write_header, delimiter, allow_empty, output_encoding)
+    
+    def write_output(self, filename, output_format=None, make_strings=False, write_header=True, delimiter=",", allow_empty=False, output_encoding=None, batch_size=writers.DEFAULT_BATCH_SIZE, **writer_options):
+        """Write the processed rows in the given format ('csv', 'parquet',
+        'arrow', 'feather' or 'sqlite'), inferred from the extension by
+        default. Without `make_strings`, the types of the values are kept by
+        the formats that can. Other options go to the writer, like the
+        `table` of SQLite.
+        """
         if (len(self.rows) <= 0) and not allow_empty:
             raise AttributeError('No rows were loaded')
-        if make_strings:
-            out = self.make_strings()
-        else:
-            out = self.rows
-        with open(filename, 'wb+', encoding=output_encoding) as f:
-            header_columns = list(self.header_keys.keys())
-            writer = csv.DictWriter(f, header_columns, delimiter=delimiter)
+        output_format = output_format or writers.infer_format(filename)
+        with self.stats.timer("write"):
+            with self._open_writer(filename, output_format, list(self.header_keys.keys()), delimiter, output_encoding, batch_size, make_strings, **writer_options) as writer:
+                if hasattr(writer, "infer_schema") and not make_strings:
+                    # every row is known: no need to guess the types from the first batch
+                    writer.infer_schema(self.rows)
+                if write_header:
+                    writer.write_header()
+                writer.write_rows(self.rows)
+        self.stats.count_written(writer)
+    
+    def _open_writer(self, filename, output_format, columns, delimiter=",", output_encoding=None, batch_size=writers.DEFAULT_BATCH_SIZE, make_strings=False, **options):
+        # values are converted to strings as they are written, rows are not copied first
+        convert = self._string_converter()
+        return writers.get_writer(output_format, filename, columns, delimiter=delimiter, output_encoding=output_encoding,
+                                  batch_size=batch_size, stringify=convert, convert=convert if make_strings else None, **options)
+    
+    def stream_rows(self, json_file, make_strings=False):
+        """Generator pipeline mapping, replacing special values and optionally
+        stringifying each row as soon as it is produced. Rows are never kept
+        in memory.
+        
+        The input is parsed incrementally unless pre-processing is used.
+        Post-processing needs every row at once, hence it is not supported.
+        """
+        if self.uses_jq and self.postprocessing:
+            raise ValueError('"post-processing" needs every row at once and cannot be used when streaming')
+        
+        replace_special_values = self._special_values_replacer()
+        convert_row = self._row_string_converter()
+        for row in self.iter_rows(self._load_target_data(json_file, incremental=True)):
+            row = replace_special_values(row)
+            if make_strings:
+                row = convert_row(row)
+            yield row
+    
+    def stream_csv(self, json_file, filename='output.csv', make_strings=False, write_header=True, delimiter=",", allow_empty=False, output_encoding=None, output_format="csv", batch_size=writers.DEFAULT_BATCH_SIZE, **writer_options):
+        """Convert the given file and write each row to the CSV file (or
+        `output_format` file) as soon as it is produced. Memory usage does
+        not grow with the input size.
+        
+        The header is the outline's "map": columns added by map-processing
+        are only written if they are declared in the "map".
+        """
+        # values are converted to strings by the writer
+        rows = self.stream_rows(json_file)
+        first_row = next(rows, None)
+        if first_row is None and not allow_empty:
+            raise AttributeError('No rows were loaded')
+        
+        # rows are produced while writing: the time of the other stages is
+        # not part of the writing
+        start, other_stages = time.perf_counter(), sum(self.stats.timings.values())
+        header_columns = list(self.key_map.keys())
+        with self._open_writer(filename, output_format, header_columns, delimiter, output_encoding, batch_size, make_strings,
+                               ignore_extra=True, **writer_options) as writer:
             if write_header:
-                writer.writeheader()
-            writer.writerows(out)
+                writer.write_header()
+            if first_row is not None:
+                writer.write_rows(itertools.chain((first_row,), rows))
+        self.stats.count_written(writer)
+        elapsed = time.perf_counter() - start
+        self.stats.timings["write"] += elapsed - (sum(self.stats.timings.values()) - other_stages)
     
+    def spill_csv(self, json_file, filename='output.csv', make_strings=False, write_header=True, delimiter=",", allow_empty=False, output_encoding=None, spill_dir=None, output_format="csv", batch_size=writers.DEFAULT_BATCH_SIZE, **writer_options):
+        """Convert the given file in two passes: rows are first written to a
+        temporary file while the header is collected, then copied to the CSV
+        file. Unlike `stream_csv`, columns added by map-processing are written
+        even if they are not in the outline's "map", and memory usage does
+        not grow with the input size either.
         
+        :param spill_dir: directory of the temporary file. Needs about as much
+                          free space as the CSV file.
+        """
+        rows = self.stream_rows(json_file, make_strings)
+        count = 0
+        import tempfile
+        with tempfile.TemporaryFile(prefix="json2csv-", suffix=".spill", dir=spill_dir) as spill:
+            # marshal is the fastest serialization of the JSON-like values
+            # of the rows, and each record knows its own length
+            dump = marshal.dump
+            for row in rows:
+                dump(row, spill)
+                count += 1
+            if not count and not allow_empty:
+                raise AttributeError('No rows were loaded')
+            
+            with self.stats.timer("write"):
+                spill.seek(0)
+                # keys found in no row are removed, like when loading
+                header_columns = list(self.header_keys.keys()) if count else []
+                load = marshal.load
+                with self._open_writer(filename, output_format, header_columns, delimiter, output_encoding, batch_size, **writer_options) as writer:
+                    if hasattr(writer, "infer_schema"):
+                        # every row is known: no need to guess the types from the first batch
+                        writer.infer_schema(load(spill) for _ in range(count))
+                        spill.seek(0)
+                    if write_header:
+                        writer.write_header()
+                    writer.write_rows(load(spill) for _ in range(count))
+        self.stats.count_written(writer)
+    
     def get_for_keypath(self, data, keypath):
         if keypath:
             keys = keypath.split(".")
@@ -337,17 +895,112 @@ class MultiLineJson2Csv(Json2Csv):
     Conceptually, multiline JSON cannot use the notion of preprocessing a whole
     input file since each line is treated one after the other in sequence,
     without ever seeing the full file.
+    
+    With more than 1 worker, the lines of the file are mapped in parallel by
+    a pool of processes, each one processing a range of lines.
+    
+    With projection, lines are parsed lazily by pysimdjson (when installed)
+    and only the values the "map" reaches are built. The whole line is
+    decoded when jq scripts need the item.
     """
+    # smallest range of bytes handed to a worker
+    MIN_WORKER_CHUNK = 1 << 20
+    
+    def __init__(self, outline, workers=1, profile=False, json_backend="auto", projection=True):
+        super(MultiLineJson2Csv, self).__init__(outline, profile=profile, json_backend=json_backend)
+        self.outline = outline
+        self.workers = workers
+        uses_item = self.uses_jq and (self.mapprocessing or any(self.key_processing_map.values()))
+        self.projection = projection and json_backend in ("auto", "simdjson") and not uses_item
+    
     def load(self, json_file):
-        self.process_each(json_file)
+        self.rows.extend(map(self._special_values_replacer(), self.iter_rows(json_file)))
+
+    def _load_target_data(self, json_file, incremental=False):
+        return json_file
 
     def process_each(self, data, collection=None):
         """Load each line of an iterable collection (ie. file)"""
-        for i, line in enumerate(data):
-            d = json.loads(line)
+        self.rows.extend(self.iter_rows(data))
+
+    def iter_rows(self, data, start=0):
+        if self.workers > 1 and self._can_split(data):
+            return self._iter_rows_parallel(data.name, data.encoding)
+        return super(MultiLineJson2Csv, self).iter_rows(data, start)
+
+    def _iter_entries(self, data):
+        if self.projection:
+            entries = jsonio.iter_projected_lines(data, self.key_map.values(), self.collection, self._loads)
+            if entries is not None:
+                return entries
+        return self._iter_decoded_lines(data)
+    
+    def _iter_decoded_lines(self, data):
+        # lines are decoded from bytes when the backend allows it
+        for d in jsonio.iter_lines(data, self._loads):
             if self.collection in d:
                 d = d[self.collection]
-            self.rows.append(self.process_row(d, i))
+            yield d
+
+    def _can_split(self, data):
+        """Whether the input is a file that can be split in ranges of lines"""
+        return jsonio.can_split_lines(data)
+
+    def _iter_rows_parallel(self, filepath, encoding):
+        """Map the lines of the file in a pool of processes.
+        Rows come out in the order of the lines and get the same index
+        (`$__row__`) as when processed sequentially.
+        """
+        ranges = jsonio.line_aligned_ranges(filepath, self.workers * 4, self.MIN_WORKER_CHUNK)
+        # the index of a row is only visible to jq scripts
+        uses_index = self.uses_jq and (self.mapprocessing or any(self.key_processing_map.values()))
+        
+        import multiprocessing
+        with multiprocessing.Pool(self.workers, initializer=_init_line_worker,
+                                  initargs=(self.outline, self.profile, self.json_backend, self.projection)) as pool:
+            first_indices = [0] * len(ranges)
+            if uses_index:
+                counts = pool.map(_count_line_range, [(filepath, start, end, encoding) for start, end in ranges])
+                first_indices = list(itertools.accumulate([0] + counts[:-1]))
+            
+            tasks = [(filepath, start, end, encoding, first_index) for (start, end), first_index in zip(ranges, first_indices)]
+            for rows, header_keys, stats in pool.imap(_process_line_range, tasks):
+                self.stats.merge(stats)
+                for key in header_keys:
+                    if key not in self.header_keys:
+                        self.header_keys[key] = None
+                for row in rows:
+                    yield row
+
+
+def _read_line_range(filepath, start, end, encoding):
+    # the range is mapped instead of being read in memory at once
+    return jsonio.MappedLines(filepath, start, end, encoding)
+
+
+_worker_loader = None
+
+
+def _init_line_worker(outline, profile=False, json_backend="auto", projection=True):
+    global _worker_loader
+    _worker_loader = MultiLineJson2Csv(outline, profile=profile, json_backend=json_backend, projection=projection)
+
+
+def _count_line_range(task):
+    filepath, start, end, encoding = task
+    return _read_line_range(filepath, start, end, encoding).count_lines()
+
+
+def _process_line_range(task):
+    """Map a range of lines in a worker process.
+    Returns the rows, the header keys they use and the stats of the range.
+    """
+    filepath, start, end, encoding, first_index = task
+    loader = _worker_loader
+    loader.reset()
+    lines = _read_line_range(filepath, start, end, encoding)
+    rows = list(loader.iter_rows(lines, first_index))
+    return rows, list(loader.header_keys.keys()), loader.stats.as_dict()
 
 
 def get_filepath_formatted_from_filepath(template, filepath):
@@ -377,19 +1030,53 @@ def init_parser():
     
     parser.add_argument('-e', '--each-line', action="store_true", default=False,
                         help="Process each line of JSON file separately")
-    parser.add_argument('-o', '--output-csv', type=str, default=None,
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes mapping the lines of a file in parallel (with --each-line). Default is 1")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of input files converted in parallel. Errors are reported per file at the end instead of stopping at the first one. Default is 1")
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument('-o', '--output-csv', type=str, default=None,
                         help="Path to csv file to output")
     parser.add_argument('--delimiter', '-d', '--csv-delimiter', type=str, default=",",
                         help="1 character CSV delimiter. Default is comma ','. You may also output in tsv with '\\t'")
     parser.add_argument('--strings', action="store_true", default=True,
         help="Convert lists, sets, and dictionaries fully to comma-separated strings.")
+    parser.add_argument('--nested-json', action="store_true", default=False,
+        help="Write lists and dictionaries as compact JSON instead of comma-separated strings")
+    parser.add_argument('--raw-types', dest="strings", action="store_false",
+        help="With Parquet and Arrow outputs, keep the types of the values (numbers, booleans, lists, ...) instead of writing strings")
+    parser.add_argument('--output-format', dest="output_format", choices=sorted(writers.FORMATS), default=None,
+        help="Format of the output files. Parquet and Arrow/Feather need pyarrow. Default is inferred from the extension of --output-csv, else csv")
+    output_group.add_argument('--output-sqlite', dest="output_sqlite", default=None, metavar="DATABASE",
+        help="Insert the rows in a table of this SQLite database instead of writing CSV files. Rows are appended to an existing table. Accepts the same placeholders as --output-csv")
+    parser.add_argument('--table', default=None,
+        help="Table of the SQLite database, created if needed. Accepts the same placeholders as --output-csv. Default is the name of the input file without extension")
+    parser.add_argument('--batch-size', dest="batch_size", type=int, default=writers.DEFAULT_BATCH_SIZE,
+        help="Number of rows per record batch of Parquet and Arrow outputs, per transaction of SQLite, and formatted at once for CSV. Default is %(default)s")
+    parser.add_argument('--write-buffer-size', dest="write_buffer_size", type=int, default=jsonio.BUFFER_SIZE,
+        help="Size in bytes of the buffer of CSV outputs. Default is %(default)s")
     parser.add_argument('--no-header', action="store_true",
                         help="Process each line of JSON file separately")
     parser.add_argument('--encoding', '--input-encoding', dest="input_encoding", help="Custom encoding to use when reading input files. Especially useful on Windows since an ANSI-compatible encoding might otherwise be used.")
     parser.add_argument('--output-encoding', dest="output_encoding", help="Custom output file encoding")
     parser.add_argument('--outline-encoding', dest="outline_encoding", help="Custom file encoding for the key maps file (outline file)")
+    parser.add_argument('--no-outline-cache', dest="outline_cache", action="store_false",
+        help="Always parse the outline file instead of loading it from the cache of parsed outlines (in $JSON2CSV_CACHE_DIR, else ~/.cache/json2csv)")
     parser.add_argument('--verbose', type=int, default=0, help="Level of logs")
-    
+    parser.add_argument('--stream', action="store_true", default=False,
+        help="Write each row to the CSV as soon as it is mapped instead of loading every row in memory first. Columns are the ones of the outline's 'map'. Not compatible with 'post-processing'.")
+    parser.add_argument('--spill', action="store_true", default=False,
+        help="Like --stream, but rows are first written to a temporary file while collecting the header, so that columns added by 'map-processing' are written too. Needs temporary disk space about the size of the CSV. Not compatible with 'post-processing'.")
+    parser.add_argument('--spill-dir', dest="spill_dir", default=None,
+        help="Directory of the temporary file used by --spill. Default is the system's temporary directory")
+    parser.add_argument('--json-backend', dest="json_backend", default="auto", choices=jsonio.BACKENDS,
+        help="Library decoding the JSON input. 'auto' picks simdjson or ujson if installed, else the standard 'json' module. orjson reads integers over 64 bits as floats, hence it is only used when asked for. Default is auto")
+    parser.add_argument('--no-projection', dest="projection", action="store_false", default=True,
+        help="With --each-line, fully decode each line even when pysimdjson is installed. By default only the values reached by the outline's 'map' are decoded, unless jq scripts need the whole line")
+    parser.add_argument('--profile', action="store_true", default=False,
+        help="Print the time spent in each stage of the conversion (parse, jq scripts, mapping, writing) and row counters for each file")
+    parser.add_argument('--profile-output', dest="profile_output", default=None,
+        help="Save the profile of each file as JSON to this path. Accepts the same placeholders as --output-csv, e.g. '{base}.profile.json'")
     
     error_mgmt_group = parser.add_argument_group("Error management")
     error_mgmt_group.add_argument('--allow-empty-file', action="store_true",
@@ -398,63 +1085,162 @@ def init_parser():
     return parser
 
 
-def convert_json_to_csv(json_file, key_map, output_csv, no_header, make_strings, each_line, delimiter, allow_empty_output, output_encoding=None):
+def convert_json_to_csv(json_file, key_map, output_csv, no_header, make_strings, each_line, delimiter, allow_empty_output, output_encoding=None, stream=False, workers=1, profile=False, profile_output=None, spill=False, spill_dir=None, json_backend="auto", projection=True, output_format=None, batch_size=writers.DEFAULT_BATCH_SIZE, table=None, nested_json=False, write_buffer_size=jsonio.BUFFER_SIZE, loader=None):
+    """Convert an opened JSON file with the outline `key_map`.
+    :param loader: Json2Csv instance of the outline to reuse instead of
+                   creating one. Its JSON backend must be the one picked by
+                   `jsonio.input_backend` for this file.
+    """
     special_inputs_map = {"\\t":"\t", "\\n":"\n"}
     csv_delimiter = special_inputs_map.get(delimiter, delimiter)
     
     try:
-        loader = None
-        if each_line:
-            loader = MultiLineJson2Csv(key_map)
+        profile = profile or bool(profile_output)
+        json_backend = jsonio.input_backend(json_file, json_backend)
+        if loader is not None:
+            loader.reset()
+        elif each_line:
+            loader = MultiLineJson2Csv(key_map, workers=workers, profile=profile, json_backend=json_backend, projection=projection)
         else:
-            loader = Json2Csv(key_map)
-
-        loader.load(json_file)
+            loader = Json2Csv(key_map, profile=profile, json_backend=json_backend)
+        loader.nested_json = nested_json
 
         outfile = output_csv
         if outfile is None:
-            fileName, fileExtension = os.path.splitext(json_file.name)
-            outfile = fileName + '.csv'
+            fileName, fileExtension = os.path.splitext(jsonio.strip_compression_extension(json_file.name))
+            outfile = fileName + writers.extension(output_format or "csv")
+        output_format = output_format or writers.infer_format(outfile)
+        output_options = dict(make_strings=make_strings, write_header=not no_header, delimiter=csv_delimiter, allow_empty=allow_empty_output,
+                              output_encoding=output_encoding, output_format=output_format, batch_size=batch_size,
+                              buffer_size=write_buffer_size)
+        if table:
+            output_options['table'] = get_filepath_formatted_from_filepath(table, json_file.name)
+        elif output_format == "sqlite":
+            output_options['table'] = os.path.basename(os.path.splitext(jsonio.strip_compression_extension(json_file.name))[0])
         
         destdir = os.path.dirname(outfile)
         if destdir:
             os.makedirs(destdir, exist_ok=True)
 
-        loader.write_csv(filename=outfile, make_strings=make_strings, write_header=not no_header, delimiter=csv_delimiter, allow_empty=allow_empty_output, output_encoding=output_encoding)
+        if spill:
+            loader.spill_csv(json_file, filename=outfile, spill_dir=spill_dir, **output_options)
+        elif stream:
+            loader.stream_csv(json_file, filename=outfile, **output_options)
+        else:
+            loader.load(json_file)
+            loader.write_output(outfile, **output_options)
+        
+        if profile:
+            print("Profile of {}:\n{}".format(json_file.name, loader.stats.report()))
+        if profile_output:
+            with open(get_filepath_formatted_from_filepath(profile_output, json_file.name), "w") as f:
+                json.dump(dict(loader.stats.as_dict(), input=json_file.name, output=outfile), f, indent=2)
+        return loader.stats
     except Exception as err:
         print("Error while processing file {}: [{}] {}".format(json_file.name, type(err), err))
         raise err
-    pass
 
 
 def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if args[:1] == ["serve"]:
+        try:
+            from . import server
+        except ImportError:
+            import server
+        return server.main(args[1:])
+    
     parser = init_parser()
     args = parser.parse_args(args)
     
-    # key_map_content = json.loads(jsmin(args.key_map.read()))
+    try:
+        from . import outlines
+    except ImportError:
+        import outlines
     # allow custom encodings
-    with open(args.key_map.name, "r", encoding=args.outline_encoding) as fh:
-        key_map_content = json.loads(jsmin(fh.read()))
+    key_map_content = outlines.load_outline(args.key_map.name, encoding=args.outline_encoding, use_cache=args.outline_cache)
     
+    import glob  # Unix-like path matching
     input_filepaths = glob.glob(args.input_json_files[0]) if len(args.input_json_files) == 1 else args.input_json_files
-    print(input_filepaths)
     
-    if args.output_csv is None:
+    if args.output_sqlite:
+        # files may share a database, in different tables or the same one
+        output_paths = [get_filepath_formatted_from_filepath(args.output_sqlite, fp) for fp in input_filepaths]
+        args.output_format = "sqlite"
+    elif args.output_csv is None:
         output_paths = [None for _ in input_filepaths]
     else:
         output_paths = [get_filepath_formatted_from_filepath(args.output_csv, fp) for fp in input_filepaths]
-    assert args.output_csv is None or len(set(output_paths)) == len(set(input_filepaths)), "Mismatched number of input-output filepaths. Number of generated output paths ({}) must match number of input files to convert ({})".format(len(output_paths), len(input_filepaths))
+        assert len(set(output_paths)) == len(set(input_filepaths)), "Mismatched number of input-output filepaths. Number of generated output paths ({}) must match number of input files to convert ({})".format(len(output_paths), len(input_filepaths))
+    
     
     
+    conversion_options = dict(no_header=args.no_header, make_strings=args.strings, each_line=args.each_line,
+                              delimiter=args.delimiter, allow_empty_output=args.allow_empty_file,
+                              output_encoding=args.output_encoding, stream=args.stream, workers=args.workers,
+                              profile=args.profile, profile_output=args.profile_output,
+                              spill=args.spill, spill_dir=args.spill_dir, json_backend=args.json_backend,
+                              projection=args.projection, output_format=args.output_format, batch_size=args.batch_size,
+                              table=args.table, nested_json=args.nested_json, write_buffer_size=args.write_buffer_size)
+    
+    if args.jobs > 1:
+        convert_files_in_pool(input_filepaths, output_paths, key_map_content, conversion_options, args.input_encoding, args.jobs)
+        return
     
     for i, filepath in enumerate(input_filepaths):
         output_filepath = output_paths[i]
         
-        with open(filepath, "r", encoding=args.input_encoding) as fileobject:
-            dt = datetime.datetime.today()
-            s_time = "{:02}:{:02}:{:02}".format(dt.hour, dt.minute, dt.second)
-            print("  {} / {} : {}  {}|  {}".format(i+1, len(input_filepaths), fileobject.name, (("-> %s  "%output_filepath) if output_filepath else ""), s_time))
-            convert_json_to_csv(fileobject, key_map_content, output_filepath, args.no_header, args.strings, args.each_line, args.delimiter, args.allow_empty_file, output_encoding=args.output_encoding)
+        with jsonio.open_input(filepath, encoding=args.input_encoding) as fileobject:
+            print(_progress_line(i, len(input_filepaths), fileobject.name, output_filepath))
+            convert_json_to_csv(fileobject, key_map_content, output_filepath, **conversion_options)
+
+
+def _progress_line(i, count, filepath, output_filepath):
+    s_time = time.strftime("%H:%M:%S")
+    return "  {} / {} : {}  {}|  {}".format(i+1, count, filepath, (("-> %s  "%output_filepath) if output_filepath else ""), s_time)
+
+
+def convert_files_in_pool(input_filepaths, output_paths, key_map, conversion_options, input_encoding=None, jobs=2):
+    """Convert the files in a pool of processes.
+    The outline is parsed once and sent once to each process. Errors are
+    collected per file and reported once every file has been processed.
+    """
+    # the processes of a pool cannot start their own pool
+    conversion_options = dict(conversion_options, workers=1)
+    
+    errors = []
+    tasks = list(zip(input_filepaths, output_paths))
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer=_init_convert_job, initargs=(key_map, conversion_options, input_encoding)) as pool:
+        for i, (filepath, output_filepath, error) in enumerate(pool.imap_unordered(_convert_file_job, tasks)):
+            print(_progress_line(i, len(tasks), filepath, output_filepath) + ("  FAILED" if error else ""))
+            if error:
+                errors.append((filepath, error))
+    
+    if errors:
+        print("Errors while converting {} of {} files:".format(len(errors), len(tasks)))
+        for filepath, error in errors:
+            print("  {}: {}".format(filepath, error))
+        raise SystemExit("{} of {} files could not be converted".format(len(errors), len(tasks)))
+
+
+_job_context = None
+
+
+def _init_convert_job(key_map, conversion_options, input_encoding):
+    global _job_context
+    _job_context = (key_map, conversion_options, input_encoding)
+
+
+def _convert_file_job(task):
+    filepath, output_filepath = task
+    key_map, conversion_options, input_encoding = _job_context
+    try:
+        with jsonio.open_input(filepath, encoding=input_encoding) as fileobject:
+            convert_json_to_csv(fileobject, key_map, output_filepath, **conversion_options)
+    except Exception as err:
+        return filepath, output_filepath, "[{}] {}".format(type(err).__name__, err)
+    return filepath, output_filepath, None
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+"""Input helpers shared by json2csv.py and gen_outline.py
+
+The incremental reader walks a JSON document down to the array holding the
+data and yields its elements one at a time, so that a huge
+`{"nodes": [...]}` file can be converted in constant memory. Each element
+is decoded with the C-accelerated `json` decoder; only the structure around
+the collection is scanned in Python.
+
+Whole documents and lines are decoded by a pluggable backend: simdjson,
+ujson or orjson when installed, else the standard `json` module.
+
+Compressed files (gzip, bzip2, xz, zstd) are read and written as streams.
+"""
+
+import codecs
+import io
+import itertools
+import json
+import mmap
+import os
+import re
+
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(r'[-+.0-9a-zA-Z]*')
+
+BACKENDS = ("auto", "simdjson", "ujson", "orjson", "json")
+# buffer of the compressed streams
+BUFFER_SIZE = 1 << 20
+
+_MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd", ".zstd": "zstd"}
+
+# size of the files decoded by the standard json module with the "auto" backend
+SMALL_INPUT_SIZE = 1 << 20
+
+# orjson reads integers over 64 bits as floats instead of failing: it is
+# only used when asked for
+AUTO_BACKENDS = ("simdjson", "ujson", "json")
+
+
+def _import_loads(backend):
+    try:
+        if backend == "orjson":
+            import orjson
+            return orjson.loads
+        if backend == "simdjson":
+            import simdjson
+            return simdjson.loads
+        if backend == "ujson":
+            import ujson
+            return ujson.loads
+    except ImportError:
+        return None
+    return json.loads
+
+
+def get_loads(backend="auto"):
+    """Return a function decoding a JSON document from `str` or `bytes`.
+    
+    Documents a fast backend rejects (big integers, NaN, ...) are decoded
+    again by the standard `json` module, so that the results do not depend
+    on the installed backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown JSON backend '{}'. Use one of: {}".format(backend, ", ".join(BACKENDS)))
+    
+    candidates = AUTO_BACKENDS if backend == "auto" else (backend,)
+    for name in candidates:
+        loads = _import_loads(name)
+        if loads is not None:
+            break
+    else:
+        import logging
+        logging.warning('JSON backend "%s" is not installed. Run "pip install %s" to install it. Using "json" instead', backend, backend)
+        loads = json.loads
+    
+    if loads is json.loads:
+        return loads
+    
+    def loads_with_fallback(s):
+        try:
+            return loads(s)
+        except (ValueError, OverflowError, RuntimeError):
+            return json.loads(s)
+    loads_with_fallback.backend = name
+    return loads_with_fallback
+
+
+def input_backend(fp, backend="auto"):
+    """Backend to decode a file object with: "auto" is the standard `json`
+    module for small files, for which importing a faster backend takes longer
+    than it saves
+    """
+    if backend != "auto":
+        return backend
+    try:
+        size = os.fstat(fp.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return backend
+    return "json" if size < SMALL_INPUT_SIZE else backend
+
+
+def _import_simdjson():
+    try:
+        import simdjson
+    except ImportError:
+        return None
+    return simdjson
+
+
+def make_projection(keypaths):
+    """Return a function copying out of a lazily parsed simdjson document only
+    the values found under the given keypaths, or None if pysimdjson is not
+    installed.
+    
+    Other values of the document are never built. The copy has the same
+    nesting as the document, except that arrays walked through become
+    dictionaries keyed by index, so that the keypaths get the same values
+    from the copy as from the fully decoded document.
+    """
+    simdjson = _import_simdjson()
+    if simdjson is None:
+        return None
+    Object, Array = simdjson.Object, simdjson.Array
+    
+    # prefix tree of the keypaths. None marks a value to copy as a whole
+    tree = {}
+    copy_document = False
+    for keys in keypaths:
+        if WILDCARD in keys:
+            # every element is needed: the list is copied as a whole
+            keys = keys[:keys.index(WILDCARD)]
+            # a wildcard first needs the whole document, a root array
+            copy_document = copy_document or not keys
+        node = tree
+        for i, key in enumerate(keys):
+            if node.get(key, False) is None:
+                break
+            if i == len(keys) - 1:
+                node[key] = None
+            else:
+                node = node.setdefault(key, {})
+    
+    def copy(value):
+        if isinstance(value, Object):
+            return value.as_dict()
+        if isinstance(value, Array):
+            return value.as_list()
+        return value
+    
+    def project(value, node):
+        if not isinstance(value, (Object, Array)):
+            return value
+        out = {}
+        for key, child in node.items():
+            try:
+                item = value[key]
+            except (KeyError, IndexError, TypeError):
+                continue
+            out[key] = copy(item) if child is None else project(item, child)
+        return out
+    
+    if copy_document:
+        return copy
+    return lambda document: project(document, tree)
+
+
+def iter_projected_lines(fp, keypaths, collection=None, loads=json.loads):
+    """Decode each line of a line-delimited JSON file, keeping only the values
+    under the given keypaths (see `make_projection`). When the line is an
+    object holding the `collection` key, its value is projected instead.
+    
+    Lines pysimdjson rejects are fully decoded by `loads`. Returns None if
+    pysimdjson is not installed.
+    """
+    project = make_projection(keypaths)
+    if project is None:
+        return None
+    simdjson = _import_simdjson()
+    
+    def iter_lines():
+        parser = simdjson.Parser()
+        Object = simdjson.Object
+        lines = binary_lines(fp)
+        if lines is None:
+            lines = fp.iter_text() if isinstance(fp, MappedLines) else fp
+        for line in lines:
+            try:
+                document = parser.parse(line)
+            except (ValueError, RuntimeError):
+                item = loads(line)
+                if collection is not None and isinstance(item, dict) and collection in item:
+                    item = item[collection]
+                yield item
+                continue
+            if collection is not None and isinstance(document, Object) and collection in document:
+                document = document[collection]
+            item = project(document)
+            # the parser is reused for the next line only once nothing
+            # references the current document anymore
+            del document
+            yield item
+    return iter_lines()
+
+
+class MappedLines(object):
+    """Lines of a range of bytes of a file, found through mmap.
+    
+    Iterating yields each line as bytes without its newline, and without
+    decoding it to text first: blocks of whole lines are split at once. The
+    range must start at the beginning of a line, and the encoding must be
+    ASCII-compatible.
+    """
+    BLOCK_SIZE = 1 << 16
+    
+    def __init__(self, filepath, start=0, end=None, encoding="utf-8"):
+        self.name = filepath
+        self.start = start
+        self.end = os.path.getsize(filepath) if end is None else end
+        self.encoding = encoding
+    
+    @property
+    def utf8(self):
+        return codecs.lookup(self.encoding).name in ("utf-8", "ascii")
+    
+    def _iter_blocks(self):
+        """Yield blocks of whole lines"""
+        if self.end <= self.start:
+            return
+        with open(self.name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, end = self.start, self.end
+            while start < end:
+                stop = min(start + self.BLOCK_SIZE, end)
+                if stop < end:
+                    newline = mm.rfind(b"\n", start, stop)
+                    if newline < 0:
+                        # a line longer than the block
+                        newline = mm.find(b"\n", stop, end)
+                    stop = end if newline < 0 else newline + 1
+                yield mm[start:stop]
+                start = stop
+    
+    def __iter__(self):
+        for block in self._iter_blocks():
+            lines = block.split(b"\n")
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+    
+    def iter_text(self):
+        """Yield each line decoded to text"""
+        encoding = self.encoding
+        for block in self._iter_blocks():
+            lines = block.decode(encoding).split("\n")
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+    
+    def count_lines(self):
+        if self.end <= self.start:
+            return 0
+        with open(self.name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = 0
+            for start in range(self.start, self.end, self.BLOCK_SIZE):
+                count += mm[start:min(start + self.BLOCK_SIZE, self.end)].count(b"\n")
+            # last line without a newline
+            return count + (mm[self.end - 1:self.end] != b"\n")
+
+
+def binary_lines(fp):
+    """An iterable of the bytes lines of a UTF-8 file (or MappedLines), else None"""
+    if isinstance(fp, MappedLines):
+        return fp if fp.utf8 else None
+    return binary_file(fp)
+
+
+def binary_file(fp):
+    """The underlying binary file of a text file if it is UTF-8 encoded
+    (that is what every fast backend decodes), else None
+    """
+    buffer = getattr(fp, "buffer", None)
+    encoding = getattr(fp, "encoding", None)
+    if buffer is None or not encoding:
+        return None
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    return buffer if name in ("utf-8", "ascii") else None
+
+
+def load(fp, loads=json.loads):
+    """Decode a whole JSON document, from bytes when possible"""
+    buffer = binary_file(fp) if loads is not json.loads else None
+    return loads(buffer.read() if buffer is not None else fp.read())
+
+
+def iter_lines(fp, loads=json.loads, indices=None):
+    """Decode each line of a line-delimited JSON file (or MappedLines), from
+    bytes when possible
+    :param indices: only decode the lines at these increasing indices
+    """
+    lines = binary_lines(fp) if loads is not json.loads else None
+    if lines is None:
+        lines = fp.iter_text() if isinstance(fp, MappedLines) else fp
+    if indices is not None:
+        lines = pick(lines, indices)
+    return map(loads, lines)
+
+
+def pick(iterable, indices):
+    """Yield the items of an iterable at the given increasing indices,
+    stopping at the end of either
+    """
+    iterator = iter(iterable)
+    position = 0
+    for index in indices:
+        for item in itertools.islice(iterator, index - position, None):
+            break
+        else:
+            return
+        yield item
+        position = index + 1
+
+
+def can_split_lines(fp):
+    """Whether a file object is a file that can be split in ranges of lines"""
+    filepath = getattr(fp, 'name', None)
+    encoding = getattr(fp, 'encoding', None)
+    if not isinstance(filepath, str) or not os.path.isfile(filepath) or not encoding:
+        return False
+    if compression(filepath):
+        # compressed streams cannot be split
+        return False
+    # byte ranges are aligned on b"\n", which needs an ASCII-compatible encoding
+    return "\n".encode(encoding) == b"\n"
+
+
+def line_aligned_ranges(filepath, parts, min_size):
+    """Split a file in ranges of bytes starting at the beginning of a line"""
+    size = os.path.getsize(filepath)
+    step = max(size // parts, min_size, 1)
+    bounds = [0]
+    with open(filepath, 'rb') as f:
+        while bounds[-1] + step < size:
+            f.seek(bounds[-1] + step)
+            f.readline()  # move to the start of the next line
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def compression_from_extension(filepath):
+    """Compression of a file according to its extension ('gzip', 'bz2',
+    'xz', 'zstd'), or None
+    """
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filepath)[1].lower())
+
+
+def compression(filepath):
+    """Compression of an existing file according to its first bytes, or else
+    its extension. None for an uncompressed file.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            head = f.read(6)
+    except OSError:
+        return compression_from_extension(filepath)
+    for magic, name in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    # a file too short to hold a magic number
+    return compression_from_extension(filepath) if len(head) < 6 else None
+
+
+def strip_compression_extension(filepath):
+    """data.json.gz -> data.json"""
+    base, ext = os.path.splitext(filepath)
+    return base if ext.lower() in COMPRESSION_EXTENSIONS else filepath
+
+
+def _open_compressed(filepath, mode, name):
+    """Binary stream of a compressed file"""
+    # each compression module is imported when first needed
+    if name == "gzip":
+        import gzip
+        # the default level 9 is several times slower for a few percent
+        return gzip.open(filepath, mode, compresslevel=6) if "w" in mode else gzip.open(filepath, mode)
+    if name == "bz2":
+        import bz2
+        return bz2.open(filepath, mode)
+    if name == "xz":
+        import lzma
+        return lzma.open(filepath, mode)
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is not installed, hence zstd files cannot be read or written. Run "pip install zstandard" to install it')
+        return zstandard.open(filepath, mode)
+    raise ValueError("Unknown compression '{}'".format(name))
+
+
+class _NamedBufferedReader(io.BufferedReader):
+    """Keeps the path of the compressed file as name, like a regular file"""
+    def __init__(self, raw, name, buffer_size=BUFFER_SIZE):
+        super(_NamedBufferedReader, self).__init__(raw, buffer_size)
+        self._name = name
+    
+    @property
+    def name(self):
+        return self._name
+
+
+def open_input(filepath, encoding=None):
+    """Open a file in text mode, decompressing it on the fly when its first
+    bytes or extension tell it is compressed
+    """
+    name = compression(filepath)
+    if name is None:
+        return open(filepath, "r", encoding=encoding)
+    buffer = _NamedBufferedReader(_open_compressed(filepath, "rb", name), filepath)
+    return io.TextIOWrapper(buffer, encoding=encoding)
+
+
+def open_output(filepath, encoding=None, newline=None, binary=False, buffer_size=BUFFER_SIZE):
+    """Open a file for writing, compressing it on the fly when its
+    extension is the one of a compression ('.gz', '.bz2', '.xz', '.zst')
+    """
+    name = compression_from_extension(filepath)
+    if name is None:
+        if binary:
+            return open(filepath, "wb+", buffering=buffer_size)
+        return open(filepath, "w", newline=newline, encoding=encoding, buffering=buffer_size)
+    buffer = io.BufferedWriter(_open_compressed(filepath, "wb", name), buffer_size)
+    return buffer if binary else io.TextIOWrapper(buffer, encoding=encoding, newline=newline)
+
+
+class JsonStreamReader(object):
+    """Event-based reader over a JSON text file object.
+
+    Only what is needed to decode the current value is kept in memory.
+    """
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=0):
+        """Read more data, discarding what was already consumed.
+        Returns False at the end of the file.
+        """
+        if self.eof:
+            return False
+        chunk = self.fp.read(max(size, self.chunk_size))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespaces and return the next significant character
+        ('' at the end of the file)
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError("Expecting one of '{}' at offset {} of the JSON buffer, got '{}'".format(chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def decode_value(self):
+        """Decode the value starting at the current position"""
+        if self._peek() not in '"[{':
+            # numbers and literals have no closing character: make sure they
+            # are not cut by the end of the buffer
+            while _SCALAR.match(self.buf, self.pos).end() == len(self.buf):
+                if not self._fill(len(self.buf) - self.pos):
+                    break
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # the value is probably cut by the end of the buffer. The
+                # buffer grows geometrically to keep retries linear.
+                if not self._fill(len(self.buf) - self.pos):
+                    raise
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """Move past the value starting at the current position without
+        building it
+        """
+        if self._peek() not in '[{':
+            self.decode_value()
+            return
+
+        depth = 0
+        while True:
+            m = _STRUCTURE.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise ValueError("Unexpected end of the JSON document")
+                continue
+
+            self.pos = m.end()
+            c = m.group()
+            if c == '"':
+                self._skip_string_end()
+            elif c in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_string_end(self):
+        while True:
+            m = _STRING_END.match(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.end()
+                return
+            if not self._fill(len(self.buf) - self.pos):
+                raise ValueError("Unterminated string in the JSON document")
+
+    def iter_array(self):
+        """Yield each element of the array starting at the current position"""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self._expect(',]') == ']':
+                return
+
+    def iter_object(self):
+        """Yield the keys of the object starting at the current position.
+
+        The value of each key must be consumed (decoded, skipped or walked
+        into) before resuming the iteration.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                raise ValueError("Expecting a property name at offset {} of the JSON buffer".format(self.pos))
+            key = self.decode_value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_items(self, path=(), drop_keys=False, fallback_to_root=False):
+        """Yield the elements of the array found under the given keys.
+        :param path: keys to walk from the root of the document
+        :param bool drop_keys: also accept a dictionary and yield its values
+        :param bool fallback_to_root: when the root is not a dictionary
+                                      holding the first key, iterate the root
+                                      instead: the elements of an array, or
+                                      the keys of a dictionary
+        """
+        if fallback_to_root and self._peek() != '{':
+            path = ()
+        for depth, key in enumerate(path):
+            if self._peek() != '{':
+                raise KeyError(key)
+            skipped_keys = []
+            for k in self.iter_object():
+                if k == key:
+                    break
+                skipped_keys.append(k)
+                self.skip_value()
+            else:
+                if fallback_to_root and depth == 0:
+                    for k in skipped_keys:
+                        yield k
+                    return
+                raise KeyError(key)
+
+        c = self._peek()
+        if c == '[':
+            for item in self.iter_array():
+                yield item
+        elif c == '{' and drop_keys:
+            for _ in self.iter_object():
+                yield self.decode_value()
+        else:
+            raise ValueError("Expecting an array at keypath '{}'".format(".".join(path)))
+
+
+# key of a keypath standing for every element of a list
+WILDCARD = "*"
+
+
+def collection_path(collection):
+    """Keys to walk to get to the collection.
+    Supports both a root key and the `.a.b` keypath notation.
+    """
+    if not collection:
+        return []
+    if collection[0] == ".":
+        return collection.split(".")[1:]
+    return [collection]
+
+
+def iter_collection(fp, collection=None, drop_root_keys=False, chunk_size=CHUNK_SIZE):
+    """Incrementally yield the items of a JSON document:
+    the array under `collection` if given, the values of the root dictionary
+    when dropping the root keys, or else the elements of the root array.
+    
+    Like when the document is loaded whole, the root itself is iterated when
+    it has no root key named `collection`. A missing `.a.b` keypath raises a
+    KeyError.
+    """
+    reader = JsonStreamReader(fp, chunk_size)
+    path = collection_path(collection)
+    fallback_to_root = bool(collection) and collection[0] != "."
+    return reader.iter_items(path, drop_keys=(drop_root_keys and not path), fallback_to_root=fallback_to_root)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Loading of outline files, shared by json2csv.py and gen_outline.py
+
+Outlines may contain comments, which are removed with jsmin before parsing
+the JSON. On large commented outlines this takes longer than the conversion
+of small files, so the parsed outline is kept in an on-disk cache keyed by a
+hash of the content of the file. Repeated runs with the same outline then load
+it with `marshal` instead.
+
+The cache lives in `$JSON2CSV_CACHE_DIR`, else `$XDG_CACHE_HOME/json2csv`,
+else `~/.cache/json2csv`. Least recently used entries are evicted once it
+grows over `MAX_CACHE_SIZE` bytes.
+"""
+
+import json
+import marshal
+import os
+from functools import lru_cache
+
+
+# bump when the cached representation changes
+CACHE_FORMAT = 1
+MAX_CACHE_SIZE = 32 << 20
+CACHE_EXTENSION = ".outline"
+
+
+def cache_dir():
+    """Directory of the outline cache"""
+    directory = os.environ.get("JSON2CSV_CACHE_DIR")
+    if directory:
+        return directory
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "json2csv")
+
+
+@lru_cache(maxsize=None)
+def _import_jsmin():
+    """jsmin, imported on first use. Without it, comments are not supported"""
+    try:
+        from jsmin import jsmin
+    except ModuleNotFoundError:
+        _log('warning', 'jsmin is not installed. Hence comments in outline file are disabled. Run "pip install jsmin" to install it')
+        jsmin = lambda x: x
+    return jsmin
+
+
+def _log(level, message, *args):
+    # logging is slow to import and rarely needed
+    import logging
+    getattr(logging, level)(message, *args)
+
+
+def parse_outline(text):
+    """Parse the text of an outline, which may contain comments"""
+    return json.loads(_import_jsmin()(text))
+
+
+def _cache_key(text):
+    import hashlib
+    digest = hashlib.sha256(text.encode("utf-8", "surrogatepass"))
+    # an entry is only valid for the same marshal format. Without jsmin, an
+    # outline with comments fails to parse, hence is never cached
+    digest.update("\0{}\0{}".format(marshal.version, CACHE_FORMAT).encode())
+    return digest.hexdigest()
+
+
+def load_outline(filepath, encoding=None, use_cache=True, directory=None, max_size=MAX_CACHE_SIZE):
+    """Load an outline file, through the on-disk cache unless `use_cache` is
+    False. Failing to read or write the cache only skips it.
+    """
+    with open(filepath, "r", encoding=encoding) as f:
+        text = f.read()
+    if not use_cache:
+        return parse_outline(text)
+
+    directory = directory or cache_dir()
+    path = os.path.join(directory, _cache_key(text) + CACHE_EXTENSION)
+    try:
+        with open(path, "rb") as f:
+            outline = marshal.load(f)
+        # the modification time orders the entries for the eviction
+        os.utime(path)
+        return outline
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, ValueError, TypeError) as err:
+        _log('debug', "Ignoring the outline cache entry %s: %s", path, err)
+
+    outline = parse_outline(text)
+    try:
+        _store(directory, path, outline)
+        evict(directory, max_size)
+    except (OSError, ValueError) as err:
+        _log('debug', "Could not write the outline cache entry %s: %s", path, err)
+    return outline
+
+
+def _store(directory, path, outline):
+    import tempfile
+    os.makedirs(directory, exist_ok=True)
+    # written aside then renamed, so that concurrent runs never read a
+    # partial entry
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(outline, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def evict(directory=None, max_size=MAX_CACHE_SIZE):
+    """Remove the least recently used entries of the cache until its size is
+    at most `max_size` bytes
+    """
+    directory = directory or cache_dir()
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(CACHE_EXTENSION):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear(directory=None):
+    """Remove every entry of the cache"""
+    evict(directory, 0)
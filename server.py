@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""Conversion server listening on a Unix socket
+
+Each run of the CLI starts an interpreter, imports the modules, parses the
+outline and compiles its jq scripts before converting a single row. For many
+small files, this takes longer than the conversions. The server loads a set of
+outlines once, and a pool of worker processes keeps a Json2Csv instance of
+each one, reused from one file to the next.
+
+Usage example:
+    python json2csv.py serve --socket /tmp/json2csv.sock -k outline.json -k users=/path/to/users_outline.json --workers 4
+
+Clients send jobs as JSON objects, one per line:
+    {"id": 1, "input": "/data/a.json", "outline": "outline", "output": "/data/a.csv", "each_line": true}
+
+Besides "id", "input", "outline" and "output" (optional, like --output-csv),
+a job accepts the options of `convert_json_to_csv` listed in `JOB_OPTIONS`.
+The server answers each job with a line, in the order the jobs end:
+    {"id": 1, "ok": true, "input": "/data/a.json", "output": "/data/a.csv", "seconds": 0.004, "stats": {...}}
+    {"id": 2, "ok": false, "error": "[FileNotFoundError] ..."}
+
+Paths are opened by the server: `submit` makes them absolute.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    from . import json2csv, jsonio, outlines, writers
+except ImportError:
+    import json2csv
+    import jsonio
+    import outlines
+    import writers
+
+
+# options a job may set, with the defaults of the CLI
+JOB_OPTIONS = OrderedDict([
+    ("no_header", False),
+    ("make_strings", True),
+    ("each_line", False),
+    ("delimiter", ","),
+    ("allow_empty_output", False),
+    ("input_encoding", None),
+    ("output_encoding", None),
+    ("stream", False),
+    ("spill", False),
+    ("spill_dir", None),
+    ("json_backend", "auto"),
+    ("projection", True),
+    ("output_format", None),
+    ("batch_size", writers.DEFAULT_BATCH_SIZE),
+    ("table", None),
+    ("nested_json", False),
+    ("write_buffer_size", jsonio.BUFFER_SIZE),
+])
+JOB_KEYS = ("id", "input", "outline", "output")
+DEFAULT_WORKERS = 2
+
+
+def outline_id(path):
+    """Identifier of an outline file in the jobs: its name without extension"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def load_outlines(specs, encoding=None, use_cache=True):
+    """Load the outlines given as "PATH" or "ID=PATH".
+    The outlines are checked by creating a Json2Csv instance of each one.
+    """
+    outline_map = OrderedDict()
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = outline_id(spec), spec
+        if name in outline_map:
+            raise ValueError("Several outlines have the id '{}'. Use --key-map ID=PATH to name them".format(name))
+        outline = outlines.load_outline(path, encoding=encoding, use_cache=use_cache)
+        json2csv.Json2Csv(outline)
+        outline_map[name] = outline
+    return outline_map
+
+
+# state of a worker: the outlines and the Json2Csv instances reused between jobs
+_outlines = None
+_loaders = {}
+
+
+def _init_worker(outline_map):
+    global _outlines
+    _outlines = outline_map
+    _loaders.clear()
+    # the instances of the default options are created before the first job
+    for name in outline_map:
+        _get_loader(name, False, "auto", True)
+
+
+def _get_loader(name, each_line, json_backend, projection):
+    key = (name, each_line, json_backend, projection)
+    loader = _loaders.get(key)
+    if loader is None:
+        if each_line:
+            loader = json2csv.MultiLineJson2Csv(_outlines[name], json_backend=json_backend, projection=projection)
+        else:
+            loader = json2csv.Json2Csv(_outlines[name], json_backend=json_backend)
+        _loaders[key] = loader
+    return loader
+
+
+def _run_job(job):
+    """Convert the input file of a job in a worker. Errors are returned in the
+    response instead of being raised
+    """
+    response = OrderedDict([("id", job.get("id")), ("ok", False)])
+    start = time.perf_counter()
+    try:
+        unknown = sorted(key for key in job if key not in JOB_KEYS and key not in JOB_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown options: {}".format(", ".join(unknown)))
+        if job.get("outline") not in _outlines:
+            raise ValueError("Unknown outline '{}'. Outlines are: {}".format(job.get("outline"), ", ".join(_outlines)))
+        if not job.get("input"):
+            raise ValueError('Missing the "input" path of the job')
+
+        options = OrderedDict((key, job.get(key, default)) for key, default in JOB_OPTIONS.items())
+        input_encoding = options.pop("input_encoding")
+        output = job.get("output")
+        if output:
+            output = json2csv.get_filepath_formatted_from_filepath(output, job["input"])
+        response["input"] = job["input"]
+        with jsonio.open_input(job["input"], encoding=input_encoding) as fileobject:
+            json_backend = jsonio.input_backend(fileobject, options.pop("json_backend"))
+            loader = _get_loader(job["outline"], bool(options["each_line"]), json_backend, options["projection"])
+            stats = json2csv.convert_json_to_csv(fileobject, _outlines[job["outline"]], output, json_backend=json_backend,
+                                                 loader=loader, **options)
+        response["ok"] = True
+        response["output"] = output
+        response["stats"] = stats.as_dict()
+    except Exception as err:
+        response["error"] = "[{}] {}".format(type(err).__name__, err)
+    response["seconds"] = time.perf_counter() - start
+    return response
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """Read the jobs of a connection and send their responses as they end.
+    The connection is closed once the client stopped sending jobs and every
+    job ended.
+    """
+
+    def handle(self):
+        lock = threading.Lock()
+
+        def respond(response):
+            data = (json.dumps(response) + "\n").encode()
+            with lock:
+                try:
+                    self.wfile.write(data)
+                except OSError:
+                    pass  # the client is gone, the job is still done
+
+        pending = []
+        for index, line in enumerate(self.rfile):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("A job must be a JSON object")
+            except ValueError as err:
+                respond(OrderedDict([("id", index), ("ok", False), ("error", "[{}] {}".format(type(err).__name__, err))]))
+                continue
+            job.setdefault("id", index)
+            pending.append(self.server.pool.apply_async(_run_job, (job,), callback=respond))
+        for result in pending:
+            result.wait()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server converting the jobs of its clients in a pool of processes.
+    With 0 workers, jobs are converted one at a time in the server process.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, outline_map, workers=DEFAULT_WORKERS):
+        self.outline_map = outline_map
+        # the processes are started before any thread of the server
+        if workers > 0:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(outline_map,))
+        else:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(1, initializer=_init_worker, initargs=(outline_map,))
+        try:
+            _remove_stale_socket(socket_path)
+            socketserver.UnixStreamServer.__init__(self, socket_path, _JobHandler)
+        except BaseException:
+            self.pool.terminate()
+            raise
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        # running jobs end before the workers stop
+        self.pool.close()
+        self.pool.join()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_stale_socket(path):
+    """Remove the socket file left by a server that did not stop cleanly"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise OSError("A server is already listening on {}".format(path))
+
+
+def submit(socket_path, jobs, timeout=None):
+    """Send jobs to a server and return their responses, in the order of the
+    jobs. Input and output paths are made absolute for the server.
+    """
+    messages = []
+    for i, job in enumerate(jobs):
+        job = dict(job, id=i)
+        if job.get("output"):
+            # placeholders are filled with the path the client knows
+            job["output"] = os.path.abspath(json2csv.get_filepath_formatted_from_filepath(job["output"], job["input"]))
+        job["input"] = os.path.abspath(job["input"])
+        messages.append(json.dumps(job) + "\n")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall("".join(messages).encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as f:
+            responses = [json.loads(line) for line in f]
+    responses.sort(key=lambda response: response["id"])
+    return responses
+
+
+def convert(socket_path, input_path, outline, output=None, timeout=None, **options):
+    """Convert a single file with a server and return its response"""
+    job = dict(options, input=input_path, outline=outline, output=output)
+    return submit(socket_path, [job], timeout)[0]
+
+
+def init_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog="json2csv serve", description="Converts JSON to CSV for the clients of a Unix socket, with preloaded outlines")
+    parser.add_argument('--socket', required=True,
+                        help="Path of the Unix socket to listen on")
+    parser.add_argument('-k', '--key-map', dest="key_maps", action="append", required=True, metavar="[ID=]PATH",
+                        help="Outline file the jobs may use, by its id. Default id is the name of the file without extension. Repeat for several outlines")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Number of processes converting the jobs. 0 converts them one at a time in the server process. Default is %(default)s")
+    parser.add_argument('--outline-encoding', dest="outline_encoding", help="Custom file encoding for the key maps files (outline files)")
+    parser.add_argument('--no-outline-cache', dest="outline_cache", action="store_false",
+                        help="Always parse the outline files instead of loading them from the cache of parsed outlines")
+    return parser
+
+
+def main(args=None):
+    args = init_parser().parse_args(args)
+    outline_map = load_outlines(args.key_maps, encoding=args.outline_encoding, use_cache=args.outline_cache)
+
+    server = JobServer(args.socket, outline_map, args.workers)
+    import signal
+    # stop cleanly, like on Ctrl-C. Set after starting the workers, which
+    # keep the default handler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print("Serving outlines {} on {} with {} workers".format(", ".join(outline_map), args.socket, args.workers), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import uuid
 EXTRAS = {
     'comments': ['jsmin'],
     'jq': ['pyjq'],
+    'columnar': ['pyarrow'],
 }
 
 setup(
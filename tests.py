@@ -1,8 +1,32 @@
 import unittest
+import csv
 import json
+import io
 import os
-from json2csv import Json2Csv, MultiLineJson2Csv
-from gen_outline import make_outline
+import gzip
+import marshal
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from json2csv import Json2Csv, MultiLineJson2Csv, jqp, main
+from gen_outline import gather_key_map_parallel, key_paths, make_outline, sample_items
+from jsonio import BACKENDS, MappedLines, get_loads, iter_collection
+import bench
+import gen_outline
+import json2csv
+import jsonio
+import outlines
+import server
+import writers
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 
 class TestJson2Csv(unittest.TestCase):
@@ -50,6 +74,25 @@ class TestJson2Csv(unittest.TestCase):
         """Ensure that array indices are properly handled as part of the dot notation"""
         pass
 
+    def test_compiled_extractor(self):
+        """The compiled extractor should match the generic keypath lookups"""
+        outline = {'map': [['author', 'source.author'], ['date', 'source.date'], ['source', 'source'],
+                           ['tag', 'tags.1'], ['computed', None, {'jq': '.'}]]}
+        loader = Json2Csv(outline)
+        items = [
+            {"source": {"author": "Someone", "date": 2}, "tags": ["a", "b"]},
+            {"source": "text", "tags": "xyz"},
+            {"source": None, "tags": {"1": "dict keys are strings"}},
+            [],
+        ]
+        for item in items:
+            self.assertEqual(loader._extract_row(item), loader._extract_row_generic(item))
+            self.assertEqual(list(loader._extract_row(item).keys()), list(loader.key_map.keys()))
+
+        # keypaths too deep to be compiled
+        loader = Json2Csv({'map': [['deep', '.'.join(['k'] * 150)]]})
+        self.assertEqual(loader.process_row({'k': {}}, 0), {'deep': None})
+
     def test_process_each(self):
         outline = {'map': [['id', '_id'], ['count', 'count']], 'collection': 'result'}
         loader = Json2Csv(outline)
@@ -158,9 +201,182 @@ class TestJson2Csv(unittest.TestCase):
         
     def test_write_csv(self):
         pass
+
+    def test_stream_csv(self):
+        """Streaming should write the same file as loading then writing"""
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']], "collection": "nodes"}
+        loader = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        loader.write_csv(filename="test.csv", make_strings=True)
+
+        streamer = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            streamer.stream_csv(f, filename="test_stream.csv", make_strings=True)
+        self.assertEqual(streamer.rows, [])
+
+        with open("test.csv") as expected, open("test_stream.csv") as output:
+            self.assertEqual(output.read(), expected.read())
+
+        os.remove("test.csv")
+        os.remove("test_stream.csv")
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_spill_csv(self):
+        """Columns added by map-processing should be written like when loading every row"""
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']], "collection": "nodes",
+                   "map-processing": '{row: $__row__}'}
+        loader = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        loader.write_csv(filename="test.csv", make_strings=True)
+
+        spiller = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            spiller.spill_csv(f, filename="test_spill.csv", make_strings=True)
+        self.assertEqual(spiller.rows, [])
+
+        with open("test.csv") as expected, open("test_spill.csv") as output:
+            self.assertEqual(output.read(), expected.read())
+
+        os.remove("test.csv")
+        os.remove("test_spill.csv")
+
+    def test_make_string(self):
+        loader = Json2Csv({"map": [['id', '_id']]})
+        self.assertEqual(loader.make_string('text'), 'text')
+        self.assertEqual(loader.make_string(None), 'None')
+        self.assertEqual(loader.make_string([1, 2.5, True]), '1, 2.5, True')
+        self.assertEqual(loader.make_string([{'a': [1, 2]}, ('x',)]), 'a: 1, 2, x')
+        self.assertEqual(loader.make_string(OrderedDict([('a', 1), ('b', None)])), 'a: 1\rb: None')
+
+        loader.nested_json = True
+        self.assertEqual(loader.make_string([{'a': [1, 2]}, ('x',)]), '[{"a":[1,2]},["x"]]')
+        self.assertEqual(loader.make_string(3), '3')
+
+    def test_profile(self):
+        """Counters should be kept, and per-row stages timed when profiling"""
+        outline = {"map": [['author', 'source.author'], ['missing', 'source.missing']], "collection": "nodes"}
+        loader = Json2Csv(outline, profile=True)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        loader.write_csv(filename="test.csv")
+        size = os.path.getsize("test.csv")
+        os.remove("test.csv")
+
+        stats = loader.stats.as_dict()
+        self.assertEqual(stats['items'], len(loader.rows))
+        self.assertEqual(stats['rows_written'], len(loader.rows))
+        self.assertEqual(stats['bytes_written'], size)
+        self.assertEqual(stats['none_fields'], len(loader.rows))
+        self.assertEqual(list(stats['timings']), list(loader.stats.STAGES))
+        self.assertGreater(stats['timings']['mapping'], 0)
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_header_keys_post_processing(self):
+        """Keys added by jq come after the map's, and keys found in no row are removed"""
+        outline = {"map": [['id', '_id'], ['author', 'source.author'], ['message', 'message.original']],
+                   "collection": "nodes",
+                   "map-processing": "{row: $__row__}",
+                   "post-processing": "map(del(.id) + (if .row == 1 then {late: true} else {} end))"}
+        loader = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        self.assertEqual(list(loader.header_keys), ['author', 'message', 'row', 'late'])
+
+    def test_stream_rows_special_values(self):
+        outline = {'map': [['id', '_id'], ['count', 'count'], ['flag', 'flag']],
+                   'special-values-mapping': {'null': 'N/A', 'true': 1, 'false': 0}}
+        loader = Json2Csv(outline)
+        with open('fixtures/bare_data.json') as f:
+            rows = loader.stream_rows(f)
+            self.assertEqual(next(rows), {'id': 'N/A', 'count': 'N/A', 'flag': 'N/A'})
     
 
 
+    def test_stream_rows_keypath_collection(self):
+        outline = {"map": [['author', 'source.author']], "collection": ".result.nodes"}
+        loader = Json2Csv(outline)
+        with io.StringIO('{"count": 2, "result": {"meta": {"a": [1, {}]}, "nodes": [{"source": {"author": "Someone"}}, {}]}}') as f:
+            f.name = 'nested.json'
+            rows = list(loader.stream_rows(f))
+
+        self.assertEqual([row['author'] for row in rows], ['Someone', ''])
+
+
+class TestMain(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        """Importing json2csv should not import the optional dependencies nor the CLI modules"""
+        script = ("import sys, json2csv; "
+                  "print(' '.join(m for m in ('pyjq', 'jsmin', 'argparse', 'multiprocessing', 'logging', 'sqlite3') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode().strip(), '')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_jobs(self):
+        """Files are converted in parallel and a broken file does not stop the others"""
+        for name in ('a.json', 'b.json'):
+            shutil.copy('fixtures/data.json', os.path.join(self.tmpdir, name))
+        with open(os.path.join(self.tmpdir, 'broken.json'), 'w') as f:
+            f.write('{"nodes": [')
+
+        inputs = os.path.join(self.tmpdir, '*.json')
+        output = os.path.join(self.tmpdir, 'out', '{base}.csv')
+        with self.assertRaises(SystemExit):
+            main([inputs, '-k', 'fixtures/outline.json', '-o', output, '--jobs', '2'])
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'out'))), ['a.csv', 'b.csv'])
+        with open(os.path.join(self.tmpdir, 'out', 'a.csv')) as f:
+            self.assertEqual(f.readline().strip(), 'author,message')
+
+
+    @unittest.skipIf(jsonio._import_simdjson() is None, "pysimdjson is not installed")
+    def test_projection_small_file(self):
+        """Small files are only projected with the simdjson backend, which gives the same output"""
+        lines = os.path.join(self.tmpdir, 'lines.json')
+        with open(lines, 'w') as f:
+            f.write('[{"a": 0}, {"a": 1}]\n[{"b": 2}, {"a": 3, "c": 4}]\n')
+        outline = os.path.join(self.tmpdir, 'outline.json')
+        with open(outline, 'w') as f:
+            json.dump({"map": [['a', '*.a'], ['c', '1.c']]}, f)
+
+        with open(lines) as f:
+            self.assertFalse(MultiLineJson2Csv({"map": [['a', 'a']]}, json_backend=jsonio.input_backend(f)).projection)
+            self.assertTrue(MultiLineJson2Csv({"map": [['a', 'a']]}, json_backend=jsonio.input_backend(f, 'simdjson')).projection)
+
+        outputs = []
+        for options in (['--json-backend', 'simdjson'], ['--no-projection']):
+            output = os.path.join(self.tmpdir, 'out.csv')
+            main([lines, '-k', outline, '-o', output, '--each-line', '--no-outline-cache'] + options)
+            with open(output) as f:
+                outputs.append(f.read())
+        self.assertEqual(outputs[0], 'a,c\n"0, 1",\n3,4\n')
+        self.assertEqual(outputs[1], outputs[0])
+
+    def test_compressed_files(self):
+        """Compressed inputs are read and outputs written according to their extension"""
+        compressed = os.path.join(self.tmpdir, 'data.json.gz')
+        with open('fixtures/data.json', 'rb') as f, gzip.open(compressed, 'wb') as out:
+            out.write(f.read())
+
+        main([compressed, '-k', 'fixtures/outline.json'])
+        main(['fixtures/data.json', '-k', 'fixtures/outline.json', '-o', os.path.join(self.tmpdir, 'plain.csv')])
+        main([compressed, '-k', 'fixtures/outline.json', '-o', os.path.join(self.tmpdir, 'out.csv.gz')])
+
+        with open(os.path.join(self.tmpdir, 'plain.csv'), newline='') as f:
+            expected = f.read()
+        with open(os.path.join(self.tmpdir, 'data.csv'), newline='') as f:
+            self.assertEqual(f.read(), expected)
+        with gzip.open(os.path.join(self.tmpdir, 'out.csv.gz'), 'rt', newline='') as f:
+            self.assertEqual(f.read(), expected)
+
+
 class TestMultiLineJson2Csv(unittest.TestCase):
 
     def test_line_delimited(self):
@@ -176,6 +392,410 @@ class TestMultiLineJson2Csv(unittest.TestCase):
         third_row = loader.rows[2]
         self.assertEqual(third_row['author'], 'Me too')
 
+    def test_stream_rows(self):
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']]}
+        loader = MultiLineJson2Csv(outline)
+        with open('fixtures/line_delimited.json') as f:
+            rows = list(loader.stream_rows(f, make_strings=True))
+
+        self.assertEqual([row['author'] for row in rows], ['Someone', 'Another', 'Me too'])
+        self.assertEqual(loader.rows, [])
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_map_processing_batch(self):
+        """Batched map-processing should give the same rows as one jq call per row"""
+        outline = {"map": [['n', 'n']], "context-constants": {"aux": {"k": 10}},
+                   "map-processing": ('if .n == 2 then error("boom") elif .n == 3 then ({a: 1}, {a: 2}) '
+                                      'elif .n == 4 then empty else {a: (.n * $n + $aux.k), row: $__row__} end')}
+        lines = [json.dumps({"n": i}) for i in range(7)]
+        results = []
+        for batch_size in (1, 3):
+            loader = MultiLineJson2Csv(dict(outline, **{"map-processing-batch-size": batch_size}))
+            loader.load(lines)
+            results.append((loader.rows, loader.header_keys))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][0][1], {'n': 1, 'a': 11, 'row': 1})
+        self.assertEqual(results[1][0][2], {'n': 2})
+
+        # a script ending with a comment is batched too
+        loader = MultiLineJson2Csv(dict(outline, **{"map-processing": "{a: .n} # comment", "map-processing-batch-size": 3}))
+        loader.load(lines)
+        self.assertNotIsInstance(loader._map_batch_program, json2csv._BrokenJqProgram)
+        self.assertEqual(loader.rows[1], {'n': 1, 'a': 1})
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_compiled_jq_programs(self):
+        """jq scripts are compiled once and shared between loaders of the same outline"""
+        outline = {"map": [['author', 'source.author'], ['upper', None, {"jq": ".source.author | ascii_upcase + $s", "args": {"s": "!"}}]],
+                   "map-processing": "{row: $__row__, name: $author}", "map-processing-batch-size": 1}
+        loader = MultiLineJson2Csv(outline)
+        self.assertIs(loader._map_program, MultiLineJson2Csv(outline)._map_program)
+
+        with open('fixtures/line_delimited.json') as f:
+            loader.load(f)
+        self.assertEqual(loader.rows[1], {'author': 'Another', 'upper': 'ANOTHER!', 'row': 1, 'name': 'Another'})
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_jq_keyword_columns(self):
+        """Columns named after jq keywords are not bound to variables, and do not break the scripts"""
+        outline = {"map": [['module', 'module'], ['if', 'if'], ['n', 'n'], ['x', None, {"jq": ".n * $n"}]],
+                   "map-processing": "{y: (.n + $n)}"}
+        loader = MultiLineJson2Csv(outline)
+        loader.load(io.StringIO('{"module": "a", "if": "b", "n": 1}'))
+        self.assertEqual(loader.rows, [{'module': 'a', 'if': 'b', 'n': 1, 'x': 1, 'y': 2}])
+        self.assertEqual(loader.stats.jq_errors, 0)
+
+    @unittest.skipIf(jqp is None, "pyjq is not installed")
+    def test_jq_file_constant(self):
+        """Scripts using $aux as a whole see its "_file_" key"""
+        outline = {"map": [['author', 'source.author']], "collection": "nodes",
+                   "context-constants": {"aux": {"k": 1}},
+                   "map-processing": "{aux_keys: ($aux | keys | join(\" \")), k: $aux.k}"}
+        loader = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        self.assertEqual(loader.rows[0], {'author': 'Someone', 'aux_keys': '_file_ k', 'k': 1})
+
+    def test_special_values(self):
+        """Special values are mapped for line-delimited files too"""
+        outline = {"map": [['id', 'id'], ['flag', 'flag'], ['name', 'name'], ['count', 'count']],
+                   "special-values-mapping": {"null": "NULL", "empty": "-", "true": 1, "false": 0}}
+        loader = MultiLineJson2Csv(outline)
+        loader.load(['{"id": 1, "flag": true, "name": "", "count": 0}', '{"id": null, "flag": false, "name": "x"}'])
+
+        self.assertEqual(loader.rows, [{'id': 1, 'flag': 1, 'name': '-', 'count': 0},
+                                       {'id': 'NULL', 'flag': 0, 'name': 'x', 'count': 'NULL'}])
+
+    def test_workers(self):
+        """Rows mapped in parallel should come out as when mapped sequentially"""
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']]}
+        if jqp:
+            outline['map-processing'] = '{row: $__row__}'
+        expected = MultiLineJson2Csv(outline)
+        with open('fixtures/line_delimited.json') as f:
+            expected.load(f)
+
+        loader = MultiLineJson2Csv(outline, workers=2)
+        loader.MIN_WORKER_CHUNK = 64  # one range per line
+        with open('fixtures/line_delimited.json') as f:
+            loader.load(f)
+
+        self.assertEqual(loader.rows, expected.rows)
+        self.assertEqual(loader.header_keys, expected.header_keys)
+
+    def test_workers_latin1(self):
+        """Ranges of lines of a file that is not UTF-8 are decoded as text"""
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']]}
+        lines = [{"source": {"author": "Ren\u00e9e %d" % i}, "message": {"original": "\u00e7a va"}} for i in range(4)]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'latin1.json')
+            with open(filename, 'w', encoding='latin-1') as f:
+                f.write("\n".join(json.dumps(line, ensure_ascii=False) for line in lines))
+            loader = MultiLineJson2Csv(outline, workers=2)
+            loader.MIN_WORKER_CHUNK = 64
+            with open(filename, encoding='latin-1') as f:
+                loader.load(f)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(loader.rows, [{'author': 'Ren\u00e9e %d' % i, 'message': '\u00e7a va'} for i in range(4)])
+
+    def test_projection(self):
+        """Only decoding the values reached by the map should give the same rows"""
+        outline = {"map": [['author', 'source.author'], ['source', 'source'], ['missing', 'source.author.x'],
+                           ['first_char', 'message.original.0'], ['message', 'message.original']]}
+        expected = MultiLineJson2Csv(outline, projection=False)
+        with open('fixtures/line_delimited.json') as f:
+            expected.load(f)
+
+        loader = MultiLineJson2Csv(outline)
+        with open('fixtures/line_delimited.json') as f:
+            loader.load(f)
+        self.assertEqual(loader.rows, expected.rows)
+
+    def test_wildcard(self):
+        """A wildcard keypath gets the values under every element of a list"""
+        outline = {"map": [['ids', 'items.*.id'], ['tags', 'tags.*'], ['first', 'items.0.id'], ['none', 'id.*']]}
+        lines = [{"id": 1, "items": [{"id": "a"}, {"name": "b"}, {"id": "c"}], "tags": [1, 2]}, {"id": 2}]
+        for projection in (True, False):
+            loader = MultiLineJson2Csv(outline, projection=projection)
+            loader.load(io.StringIO("\n".join(json.dumps(line) for line in lines)))
+            # missing values are written as empty strings
+            self.assertEqual(loader.rows, [{'ids': ['a', 'c'], 'tags': [1, 2], 'first': 'a', 'none': ''},
+                                           {'ids': '', 'tags': '', 'first': '', 'none': ''}])
+            self.assertEqual(loader._extract_row(lines[0]), loader._extract_row_generic(lines[0]))
+
+    def test_wildcard_root_array(self):
+        """A wildcard first walks the elements of lines that are arrays"""
+        outline = {"map": [['a', '*.a'], ['first', '0.a']]}
+        lines = [[{"a": 0}, {"a": 1}], [{"b": 2}, {"a": 3}]]
+        for projection in (True, False):
+            loader = MultiLineJson2Csv(outline, projection=projection)
+            loader.load(io.StringIO("\n".join(json.dumps(line) for line in lines)))
+            self.assertEqual(loader.rows, [{'a': [0, 1], 'first': 0}, {'a': [3], 'first': ''}])
+
+    def test_workers_stats(self):
+        """Stats of the worker processes should be merged"""
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']]}
+        loader = MultiLineJson2Csv(outline, workers=2, profile=True)
+        loader.MIN_WORKER_CHUNK = 64
+        with open('fixtures/line_delimited.json') as f:
+            loader.load(f)
+        self.assertEqual(loader.stats.items, len(loader.rows))
+
+
+class TestCsvWriter(unittest.TestCase):
+
+    def test_chunks(self):
+        """Rows written by chunks should be the ones csv.DictWriter writes"""
+        rows = [{'id': i, 'name': 'n,%d' % i} if i % 3 else {'id': i} for i in range(7)]
+        expected = io.StringIO(newline='')
+        dict_writer = csv.DictWriter(expected, ['id', 'name'])
+        dict_writer.writeheader()
+        dict_writer.writerows(rows)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'out.csv')
+            with writers.CsvWriter(filename, ['id', 'name'], batch_size=2, buffer_size=16) as writer:
+                writer.write_header()
+                writer.write_rows(rows[:5])
+                writer.write_row(rows[5])
+                writer.write_rows(iter(rows[6:]))
+            self.assertEqual(writer.rows_written, 7)
+            with open(filename, newline='') as f:
+                self.assertEqual(f.read(), expected.getvalue())
+            self.assertEqual(writer.bytes_written, len(expected.getvalue()))
+
+            with writers.CsvWriter(filename, ['id']) as writer:
+                self.assertRaises(ValueError, writer.write_rows, rows)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_missing_columns(self):
+        """Columns missing from a row are empty, whether values are converted or not"""
+        rows = [{'id': 1, 'name': 'a'}, {'id': 2}, {'name': 'c'}]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outputs = []
+            for convert in (None, str):
+                filename = os.path.join(tmpdir, 'out.csv')
+                with writers.CsvWriter(filename, ['id', 'name'], convert=convert) as writer:
+                    writer.write_rows(rows)
+                with open(filename, newline='') as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], '1,a\r\n2,\r\n,c\r\n')
+            self.assertEqual(outputs[1], outputs[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestDbApiWriter(unittest.TestCase):
+
+    def test_sqlite(self):
+        """Rows are inserted in batches, nested values as strings, other values with their type"""
+        connection = sqlite3.connect(':memory:')
+        rows = [{'id': i, 'name': 'n%d' % i, 'tags': [i, i + 1]} for i in range(5)]
+        with writers.DbApiWriter(connection, 'my "table"', ['id', 'name', 'tags'], batch_size=2, stringify=json.dumps,
+                                 column_type=None) as writer:
+            writer.write_rows(rows)
+        self.assertEqual(writer.rows_written, 5)
+        self.assertEqual(connection.execute('SELECT * FROM "my ""table""" ORDER BY id').fetchall(),
+                         [(i, 'n%d' % i, '[%d, %d]' % (i, i + 1)) for i in range(5)])
+
+        # missing values are NULL, not converted
+        with writers.DbApiWriter(connection, 'converted', ['id', 'name'], convert=str) as writer:
+            writer.write_rows([{'id': 1}, {'name': 'b'}])
+        self.assertEqual(connection.execute('SELECT * FROM converted').fetchall(), [('1', None), (None, 'b')])
+
+    def test_output_sqlite(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            database = os.path.join(tmpdir, 'out.db')
+            main(['fixtures/data.json', '-k', 'fixtures/outline.json', '--output-sqlite', database, '--table', 'nodes'])
+            connection = sqlite3.connect(database)
+            self.assertEqual(connection.execute('SELECT author, message FROM nodes').fetchall()[0], ('Someone', 'Hey!'))
+
+            # files may share the same table
+            main(['fixtures/data.json', 'fixtures/data.json', '-k', 'fixtures/outline.json', '--output-sqlite', database, '--table', 'shared'])
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM shared').fetchall(), [(6,)])
+            connection.close()
+
+            with self.assertRaises(SystemExit):
+                main(['fixtures/data.json', '-k', 'fixtures/outline.json', '--output-sqlite', database, '-o', 'out.csv'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rows = [{'id': 1, 'name': 'a', 'tags': [1, 2], 'empty': None},
+                     {'id': 2, 'name': None, 'tags': [], 'empty': None},
+                     {'id': 3, 'name': 'c', 'tags': [3], 'empty': None}]
+        self.columns = ['id', 'name', 'tags', 'empty']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_infer_format(self):
+        self.assertEqual(writers.infer_format('a/b.parquet'), 'parquet')
+        self.assertEqual(writers.infer_format('b.feather.gz'), 'feather')
+        self.assertEqual(writers.infer_format('b.json'), 'csv')
+
+    def test_raw_types(self):
+        """Types are inferred from the first batch, and columns without values are strings"""
+        import pyarrow.parquet
+        filename = os.path.join(self.tmpdir, 'out.parquet')
+        with writers.get_writer('parquet', filename, self.columns, batch_size=2) as writer:
+            writer.write_rows(self.rows)
+        table = pyarrow.parquet.read_table(filename)
+        self.assertEqual(table.to_pylist(), self.rows)
+        self.assertEqual(str(table.schema.field('id').type), 'int64')
+        self.assertEqual(str(table.schema.field('empty').type), 'string')
+
+    def test_missing_columns(self):
+        """Columns missing from a row are null, whether values are converted or not"""
+        import pyarrow.feather
+        filename = os.path.join(self.tmpdir, 'out.feather')
+        rows = [{'id': 1, 'name': 'a'}, {'id': 2}]
+        for convert in (None, str):
+            with writers.get_writer('feather', filename, ['id', 'name'], convert=convert) as writer:
+                writer.write_rows(rows)
+            self.assertEqual(pyarrow.feather.read_table(filename).column('name').to_pylist(), ['a', None])
+
+    def test_mismatched_types(self):
+        filename = os.path.join(self.tmpdir, 'out.arrow')
+        rows = self.rows + [{'id': 'four'}]
+        with self.assertRaises(ValueError):
+            with writers.get_writer('arrow', filename, self.columns, batch_size=3) as writer:
+                writer.write_rows(rows)
+
+        # the file is closed with the batches written before the error
+        import pyarrow.parquet
+        filename = os.path.join(self.tmpdir, 'out.parquet')
+        with self.assertRaises(ValueError):
+            with writers.get_writer('parquet', filename, self.columns, batch_size=3) as writer:
+                writer.write_rows(rows)
+        self.assertEqual(pyarrow.parquet.read_table(filename).num_rows, 3)
+
+    def test_spill_types(self):
+        """With --spill, the types are inferred from every row"""
+        import pyarrow.parquet
+        outline = {"map": [['a', 'a'], ['b', 'b']]}
+        lines = [json.dumps({"a": i, "b": i}) for i in range(5)] + [json.dumps({"a": "five", "b": 5.5})]
+        filename = os.path.join(self.tmpdir, 'out.parquet')
+        loader = MultiLineJson2Csv(outline)
+        loader.spill_csv(lines, filename, output_format='parquet', batch_size=2)
+        table = pyarrow.parquet.read_table(filename)
+        self.assertEqual(str(table.schema.field('a').type), 'string')
+        self.assertEqual(str(table.schema.field('b').type), 'double')
+        self.assertEqual(table.column('a').to_pylist(), ['0', '1', '2', '3', '4', 'five'])
+
+    def test_write_output(self):
+        """Strings are written the same way as in a CSV file"""
+        import pyarrow.feather
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']], "collection": "nodes"}
+        loader = Json2Csv(outline)
+        with open('fixtures/data.json') as f:
+            loader.load(f)
+        filename = os.path.join(self.tmpdir, 'out.feather')
+        loader.write_output(filename, make_strings=True)
+        table = pyarrow.feather.read_table(filename)
+        self.assertEqual(table.column_names, ['author', 'message'])
+        self.assertEqual(table.to_pylist(), loader.make_strings())
+
+
+class TestJsonIo(unittest.TestCase):
+
+    def test_input_backend(self):
+        """The auto backend is the json module for small files"""
+        with open('fixtures/data.json') as f:
+            self.assertEqual(jsonio.input_backend(f), 'json')
+            self.assertEqual(jsonio.input_backend(f, 'ujson'), 'ujson')
+        self.assertEqual(jsonio.input_backend(io.StringIO('[]')), 'auto')
+
+    def test_backends(self):
+        """Every backend should decode like the json module, even what fast backends reject"""
+        documents = ['{"a": [1, 2.5, "\\u00e9"], "b": null}', '{"big": 123456789012345678901234567890}', '[NaN]']
+        for backend in BACKENDS:
+            loads = get_loads(backend)
+            # orjson reads big integers as floats
+            for document in (documents[:1] if backend == "orjson" else documents[:2]):
+                self.assertEqual(loads(document), json.loads(document))
+                self.assertEqual(loads(document.encode()), json.loads(document))
+            self.assertEqual(repr(loads(documents[2])), repr(json.loads(documents[2])))
+        with self.assertRaises(ValueError):
+            get_loads("yaml")
+
+    def test_mapped_lines(self):
+        """Lines should be the ones of the file whatever the block size and range"""
+        with open('fixtures/line_delimited.json', 'rb') as f:
+            content = f.read()
+        expected = content.splitlines()
+        middle = content.index(b"\n") + 1
+        for block_size in (1, 16, 1 << 16):
+            lines = MappedLines('fixtures/line_delimited.json')
+            lines.BLOCK_SIZE = block_size
+            self.assertEqual(list(lines), expected)
+            self.assertEqual(list(lines.iter_text()), [line.decode() for line in expected])
+            self.assertEqual(lines.count_lines(), len(expected))
+
+            head, tail = MappedLines('fixtures/line_delimited.json', 0, middle), MappedLines('fixtures/line_delimited.json', middle)
+            self.assertEqual(list(head) + list(tail), expected)
+            self.assertEqual(head.count_lines() + tail.count_lines(), len(expected))
+
+    def test_line_delimited_backends(self):
+        outline = {"map": [['author', 'source.author'], ['message', 'message.original']]}
+        expected = MultiLineJson2Csv(outline, json_backend="json")
+        with open('fixtures/line_delimited.json') as f:
+            expected.load(f)
+        for backend in BACKENDS:
+            loader = MultiLineJson2Csv(outline, json_backend=backend)
+            with open('fixtures/line_delimited.json') as f:
+                loader.load(f)
+            self.assertEqual(loader.rows, expected.rows)
+
+    def test_iter_collection(self):
+        """Items should be the same whatever the chunk size"""
+        with open('fixtures/data.json') as f:
+            expected = json.load(f)['nodes']
+        for chunk_size in (1, 7, 1 << 16):
+            with open('fixtures/data.json') as f:
+                self.assertEqual(list(iter_collection(f, 'nodes', chunk_size=chunk_size)), expected)
+
+    def test_iter_collection_skips_siblings(self):
+        text = '{"skip": {"a": ["]", "}\\"", {"b": [1, 2]}]}, "other": 12345, "x": {"y": [1.5e3, true, null, "z"]}}'
+        for chunk_size in (1, 3, 1 << 16):
+            items = iter_collection(io.StringIO(text), '.x.y', chunk_size=chunk_size)
+            self.assertEqual(list(items), [1500.0, True, None, "z"])
+
+    def test_iter_collection_drop_root_keys(self):
+        text = '{"12": {"productId": 12}, "13": {"productId": 13}}'
+        items = iter_collection(io.StringIO(text), drop_root_keys=True, chunk_size=4)
+        self.assertEqual(list(items), [{"productId": 12}, {"productId": 13}])
+
+        with open('fixtures/bare_data.json') as f:
+            self.assertEqual(len(list(iter_collection(f, drop_root_keys=True))), 3)
+
+    def test_iter_collection_missing_key(self):
+        """A missing root key falls back to the root, like when loading the whole document"""
+        self.assertEqual(list(iter_collection(io.StringIO('{"nodes": [], "other": 1}'), 'results')), ['nodes', 'other'])
+        self.assertEqual(list(iter_collection(io.StringIO('[{"a": 1}, 2]'), 'results')), [{"a": 1}, 2])
+        items = iter_collection(io.StringIO('{"nodes": []}'), '.results.items')
+        self.assertRaises(KeyError, list, items)
+
+        outline = {"map": [['author', 'source.author']], "collection": "results"}
+        for document in ('fixtures/bare_data.json', 'fixtures/data.json'):
+            loader = Json2Csv(outline)
+            with open(document) as f:
+                loader.load(f)
+            with open(document) as f:
+                self.assertEqual(list(Json2Csv(outline).stream_rows(f)), loader.rows)
+
 
 class TestGenOutline(unittest.TestCase):
 
@@ -236,3 +856,186 @@ class TestGenOutline(unittest.TestCase):
                 ]
             }
             self.assertEqual(outline, expected)
+
+    def test_key_paths(self):
+        """Paths of the leaves as tuples, depth first"""
+        data = {"a": {"b": [1, {"c": 2}], "d": {}}, "e": 3}
+        self.assertEqual(list(key_paths(data)), [('a', 'b', 0), ('a', 'b', 1, 'c'), ('e',)])
+        self.assertEqual(list(key_paths(3)), [()])
+
+    def test_array_collapsing(self):
+        """List indices can be bounded or replaced by a wildcard"""
+        data = {"a": [{"b": 1}, {"c": 2}, {"b": 3}], "d": [4, 5]}
+        self.assertEqual(list(key_paths(data, max_array_index=0)), [('a', 0, 'b'), ('d', 0)])
+        self.assertEqual(list(key_paths(data, array_wildcard=True)),
+                         [('a', '*', 'b'), ('a', '*', 'c'), ('a', '*', 'b'), ('d', '*'), ('d', '*')])
+
+        with open('fixtures/deeply_nested.json') as json_file:
+            outline = make_outline(json_file, False, 'nodes', True, special_values=False, array_wildcard=True)
+        self.assertEqual(outline['map'], [('one_*_two_*_three_*', 'one.*.two.*.three.*')])
+        with open('fixtures/different_keys_per_row.json') as json_file:
+            outline = make_outline(json_file, False, 'nodes', True, special_values=False, max_array_index=1)
+        self.assertEqual([keypath for _, keypath in outline['map']], ['tags.0', 'tags.1', 'that', 'theother', 'this'])
+
+    def test_sort_mixed_keys(self):
+        """Sorting should not fail when a value is a list in some items and a dictionary in others"""
+        key_map = {('a', 'x'): True, ('a', 10): True, ('a', 2): True, ('b',): True}
+        outline = gen_outline.key_map_to_list(key_map, should_sort=True)
+        self.assertEqual([keypath for _, keypath in outline], ['a.2', 'a.10', 'a.x', 'b'])
+
+    def test_sample(self):
+        """Sampled items keep their order, and the same seed draws the same items"""
+        select = lambda indices=None: jsonio.pick(range(1000), indices)
+        sample = sample_items(select, 10, seed=1)
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(sample, sorted(sample))
+        self.assertEqual(sample, sample_items(select, 10, seed=1))
+        self.assertEqual(sample_items(select, 2000), list(range(1000)))
+        self.assertEqual(list(sample_items(select, rate=1)), list(range(1000)))
+        self.assertEqual(list(sample_items(select, rate=0)), [])
+
+        with open('fixtures/data.json') as json_file:
+            full = make_outline(json_file, False, 'nodes', False, special_values=False)
+        with open('fixtures/data.json') as json_file:
+            self.assertEqual(make_outline(json_file, False, 'nodes', False, special_values=False, sample=100), full)
+        with open('fixtures/line_delimited.json') as json_file:
+            outline = make_outline(json_file, True, None, True, special_values=False, sample=1, seed=0)
+            self.assertLessEqual(len(outline['map']), 3)
+
+    def test_workers(self):
+        """Key maps gathered over ranges of lines are merged in order"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'data.ndjson')
+            with open(filepath, 'w') as f:
+                for i in range(300):
+                    f.write(json.dumps({"id": i, "k%d" % (i // 50): [i] * (i % 3)}) + "\n")
+            with open(filepath) as json_file:
+                expected = gen_outline.gather_key_map(gen_outline.line_iter(json_file))
+            key_map = gather_key_map_parallel(filepath, 'utf-8', 2, min_chunk=64)
+            self.assertEqual(list(key_map), list(expected))
+            key_map = gather_key_map_parallel(filepath, 'utf-8', 2, sample=1000, min_chunk=64)
+            self.assertEqual(list(key_map), list(expected))
+            key_map = gather_key_map_parallel(filepath, 'utf-8', 2, sample=5, seed=0, min_chunk=64)
+            self.assertTrue(set(key_map) <= set(expected))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestOutlineCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        self.outline_path = os.path.join(self.tmpdir, 'outline.json')
+        with open(self.outline_path, 'w') as f:
+            f.write('{\n  // comment\n  "map": [["author", "source.author"]], "collection": "nodes"\n}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def entries(self):
+        return sorted(os.listdir(self.cache))
+
+    def test_cache(self):
+        """The parsed outline is stored then loaded from the cache"""
+        expected = {"map": [["author", "source.author"]], "collection": "nodes"}
+        self.assertEqual(outlines.load_outline(self.outline_path, directory=self.cache), expected)
+        entry, = self.entries()
+
+        # the entry is read instead of the file
+        with open(os.path.join(self.cache, entry), 'wb') as f:
+            marshal.dump({"map": []}, f)
+        self.assertEqual(outlines.load_outline(self.outline_path, directory=self.cache), {"map": []})
+        self.assertEqual(outlines.load_outline(self.outline_path, use_cache=False), expected)
+
+        # a corrupted entry is replaced
+        with open(os.path.join(self.cache, entry), 'wb') as f:
+            f.write(b'\x00')
+        self.assertEqual(outlines.load_outline(self.outline_path, directory=self.cache), expected)
+        self.assertEqual(outlines.load_outline(self.outline_path, directory=self.cache), expected)
+
+        # a different content is another entry
+        with open(self.outline_path, 'a') as f:
+            f.write('\n')
+        outlines.load_outline(self.outline_path, directory=self.cache)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_eviction(self):
+        """Least recently used entries are removed past the size limit"""
+        for i in range(3):
+            with open(self.outline_path, 'w') as f:
+                json.dump({"map": [["c%d" % i, "k"]]}, f)
+            outlines.load_outline(self.outline_path, directory=self.cache)
+            path = os.path.join(self.cache, max(self.entries(), key=lambda e: os.path.getmtime(os.path.join(self.cache, e))))
+            os.utime(path, (i, i))
+        size = os.path.getsize(path)
+        outlines.evict(self.cache, 2 * size)
+        self.assertEqual(len(self.entries()), 2)
+        outlines.clear(self.cache)
+        self.assertEqual(self.entries(), [])
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'json2csv.sock')
+        outline_map = server.load_outlines(['fixtures/outline.json', 'lines=fixtures/outline.json'], use_cache=False)
+        # jobs are converted in the server process
+        self.server = server.JobServer(self.socket_path, outline_map, workers=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_jobs(self):
+        """Jobs are converted with the preloaded outlines, and errors are reported per job"""
+        line_delimited = os.path.join(self.tmpdir, 'lines.json')
+        with open(line_delimited, 'w') as f:
+            f.write('{"source": {"author": "Someone"}, "message": {"original": "Hello"}}\n{"source": {"author": "Another"}}\n')
+        output = os.path.join(self.tmpdir, '{base}.csv')
+        responses = server.submit(self.socket_path, [
+            {"input": 'fixtures/data.json', "outline": 'outline', "output": output},
+            {"input": 'fixtures/data.json', "outline": 'outline', "output": output, "no_header": True},
+            {"input": line_delimited, "outline": 'lines', "output": output, "each_line": True},
+            {"input": 'fixtures/data.json', "outline": 'missing'},
+            {"input": 'fixtures/data.json', "outline": 'outline', "unknown": 1},
+        ])
+
+        self.assertEqual([r['ok'] for r in responses], [True, True, True, False, False])
+        self.assertEqual(responses[0]['stats']['rows_written'], 3)
+        with open('fixtures/data.csv', newline='') as f:
+            expected = f.read()
+        with open(os.path.join(self.tmpdir, 'data.csv'), newline='') as f:
+            self.assertEqual(f.read(), expected.split('\r\n', 1)[1])
+        with open(os.path.join(self.tmpdir, 'lines.csv')) as f:
+            self.assertEqual(f.read().splitlines(), ['author,message', 'Someone,Hello', 'Another,'])
+        self.assertIn('Unknown outline', responses[3]['error'])
+        self.assertIn('unknown', responses[4]['error'])
+
+        # the instances of the outlines are reused
+        self.assertEqual(len(server._loaders), 4)
+        response = server.convert(self.socket_path, 'fixtures/data.json', 'outline', os.path.join(self.tmpdir, 'again.csv'))
+        self.assertEqual(response['stats']['items'], 3)
+        self.assertEqual(len(server._loaders), 4)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_benchmark(self):
+        results = bench.benchmark(rows=50, columns=7, depth=3, sparsity=0.5, repeat=1)
+        self.assertEqual(list(results['stages'])[:2], ['parse', 'process_row'])
+        self.assertIn('write_csv', results['stages'])
+        self.assertGreater(results['total']['rows_per_s'], 0)
+        json.dumps(results)
+
+    def test_startup_benchmark(self):
+        results = bench.startup_benchmark(repeat=1)
+        self.assertGreater(results['import_ms'], 0)
+        self.assertLessEqual(len(results['slowest']), results['modules'])
+        json.dumps(results)
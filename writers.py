@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+"""Output formats of json2csv.py
+
+Every writer takes rows as dictionaries and writes the given columns in
+order. CSV is always available. Parquet and Arrow IPC (Feather) files need
+pyarrow: rows are buffered into columnar record batches. Rows can also be
+inserted in a table of a database through any DB-API 2 driver, SQLite
+being built in.
+"""
+
+import csv
+import itertools
+import operator
+import os
+
+try:
+    from . import jsonio
+except ImportError:
+    import jsonio
+
+
+DEFAULT_BATCH_SIZE = 1 << 16
+
+
+class RowWriter(object):
+    """Base class of the output formats. Use it as a context manager.
+
+    :param convert: function applied to each value before writing it, like
+                    the conversion to strings
+    """
+
+    def __init__(self, filename, columns, convert=None):
+        self.filename = filename
+        self.columns = list(columns)
+        self.convert = convert
+        self.rows_written = 0
+
+    def write_header(self):
+        pass
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @property
+    def bytes_written(self):
+        """Size of the output file once closed, or None"""
+        try:
+            return os.path.getsize(self.filename)
+        except (OSError, TypeError):
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchWriter(RowWriter):
+    """Buffers rows and writes them by batches of `batch_size` rows with
+    `write_batch`
+    """
+
+    def __init__(self, filename, columns, batch_size=DEFAULT_BATCH_SIZE, convert=None):
+        super(BatchWriter, self).__init__(filename, columns, convert)
+        self.batch_size = max(batch_size, 1)
+        self.buffer = []
+
+    def write_row(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def write_batch(self, rows):
+        raise NotImplementedError
+
+    def flush(self):
+        """Write the buffered rows as a batch"""
+        if not self.buffer:
+            return
+        self.write_batch(self.buffer)
+        self.rows_written += len(self.buffer)
+        self.buffer = []
+
+
+class CsvWriter(RowWriter):
+    """Rows are turned into tuples in the order of the columns, and written
+    by chunks of `batch_size` rows with `csv.writer.writerows` through a
+    buffer of `buffer_size` bytes.
+
+    :param bool ignore_extra: ignore the keys of the rows that are not
+                              columns instead of raising a ValueError
+    """
+
+    def __init__(self, filename, columns, delimiter=",", output_encoding=None, ignore_extra=False, convert=None,
+                 batch_size=DEFAULT_BATCH_SIZE, buffer_size=jsonio.BUFFER_SIZE, **options):
+        super(CsvWriter, self).__init__(filename, columns, convert)
+        self.ignore_extra = ignore_extra
+        self.batch_size = max(batch_size, 1)
+        self.file = jsonio.open_output(filename, encoding=output_encoding, newline='', buffer_size=buffer_size)
+        self.writer = csv.writer(self.file, delimiter=delimiter)
+
+    def write_header(self):
+        self.writer.writerow(self.columns)
+
+    def write_row(self, row):
+        self.write_rows((row,))
+
+    def _values_getter(self):
+        """Function returning the values of a row as a tuple in column order"""
+        columns = self.columns
+        column_set = set(columns)
+        ignore_extra = self.ignore_extra
+        convert = self.convert
+        if len(columns) == 1:
+            column = columns[0]
+            itemgetter = lambda row: (row[column],)
+        else:
+            itemgetter = operator.itemgetter(*columns)
+
+        def values(row):
+            if not ignore_extra and not row.keys() <= column_set:
+                raise ValueError("dict contains fields not in fieldnames: " + ", ".join(repr(k) for k in row.keys() - column_set))
+            try:
+                values = itemgetter(row)
+            except KeyError:
+                # missing keys are written as empty values, which are not
+                # converted
+                if convert:
+                    return tuple(convert(row[column]) if column in row else '' for column in columns)
+                return tuple(row.get(column, '') for column in columns)
+            return tuple(map(convert, values)) if convert else values
+        return values
+
+    def write_rows(self, rows):
+        if not self.columns:
+            return
+        values = self._values_getter()
+        writerows = self.writer.writerows
+        rows = iter(rows)
+        while True:
+            chunk = [values(row) for row in itertools.islice(rows, self.batch_size)]
+            if not chunk:
+                return
+            writerows(chunk)
+            self.rows_written += len(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is not installed, hence Parquet and Arrow files cannot be written. Run "pip install pyarrow" to install it')
+    return pyarrow
+
+
+class ArrowBatchWriter(BatchWriter):
+    """Buffers rows into record batches of `batch_size` rows.
+
+    Column types are inferred from the first batch, or from the rows given
+    to `infer_schema`. Columns without any value in those rows, or with
+    values of different types, are string columns: their values are
+    converted with `stringify`. Integers and floats make float columns.
+    """
+
+    def __init__(self, filename, columns, batch_size=DEFAULT_BATCH_SIZE, stringify=str, convert=None, **options):
+        super(ArrowBatchWriter, self).__init__(filename, columns, batch_size, convert)
+        self.pa = _import_pyarrow()
+        self.stringify = stringify
+        self.schema = None
+        self.writer = None
+        self.file = jsonio.open_output(filename, binary=True)
+
+    def infer_schema(self, rows):
+        """Infer the column types from an iterable of rows, read by batches
+        of `batch_size` rows
+        """
+        pa = self.pa
+        types = {column: pa.null() for column in self.columns}
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            for column in self.columns:
+                if pa.types.is_string(types[column]):
+                    continue
+                try:
+                    data_type = pa.array(self._column_values(column, batch)).type
+                except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                    data_type = pa.string()
+                types[column] = self._merge_types(types[column], data_type)
+        self.schema = pa.schema([pa.field(column, pa.string() if pa.types.is_null(types[column]) else types[column])
+                                 for column in self.columns])
+
+    def _merge_types(self, a, b):
+        """Type of a column with values of the types a and b"""
+        pa = self.pa
+        if a == b or pa.types.is_null(b):
+            return a
+        if pa.types.is_null(a):
+            return b
+        numeric = lambda t: pa.types.is_integer(t) or pa.types.is_floating(t)
+        if numeric(a) and numeric(b):
+            return pa.float64()
+        return pa.string()
+
+    def _open_writer(self, sink, schema):
+        raise NotImplementedError
+
+    def _column_values(self, column, rows):
+        convert = self.convert
+        if convert:
+            # missing values stay null
+            return [convert(row[column]) if column in row else None for row in rows]
+        return [row.get(column) for row in rows]
+
+    def _column_array(self, field, values):
+        pa = self.pa
+        if pa.types.is_string(field.type):
+            stringify = self.stringify
+            values = [v if v is None or isinstance(v, str) else stringify(v) for v in values]
+        try:
+            return pa.array(values, type=field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as err:
+            raise ValueError("Values of column '{}' do not match the type {} inferred from the first rows: {}. "
+                             "Use a larger batch size or write strings".format(field.name, field.type, err))
+
+    def flush(self):
+        # the file is written even without rows
+        if self.schema is None:
+            self.infer_schema(self.buffer)
+        if self.writer is None:
+            self.writer = self._open_writer(self.file, self.schema)
+        super(ArrowBatchWriter, self).flush()
+
+    def write_batch(self, rows):
+        """Write the rows as a record batch"""
+        arrays = [self._column_array(field, self._column_values(field.name, rows)) for field in self.schema]
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            # the file gets its footer even when the last batch failed
+            try:
+                if self.writer is not None:
+                    self.writer.close()
+            finally:
+                self.file.close()
+
+
+class ParquetWriter(ArrowBatchWriter):
+    def _open_writer(self, sink, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(sink, schema)
+
+
+class ArrowIpcWriter(ArrowBatchWriter):
+    """Arrow IPC file format, also known as Feather version 2"""
+    compression = None
+
+    def _open_writer(self, sink, schema):
+        options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+        return self.pa.ipc.new_file(sink, schema, options=options)
+
+
+class FeatherWriter(ArrowIpcWriter):
+    # the default of pyarrow.feather
+    compression = "lz4"
+
+
+def quote_identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+class DbApiWriter(BatchWriter):
+    """Inserts rows in a table through a DB-API 2 connection, with
+    `executemany` over batches of `batch_size` rows. Each batch is committed
+    in its own transaction.
+
+    The table is created from the columns if it does not exist yet. Lists
+    and dictionaries are converted with `stringify`.
+
+    :param paramstyle: the `paramstyle` of the driver module ('qmark',
+                       'format', 'numeric', 'named' or 'pyformat')
+    :param column_type: SQL type of the columns of the created table. None
+                        leaves the columns untyped (which SQLite allows).
+    """
+
+    def __init__(self, connection, table, columns, batch_size=DEFAULT_BATCH_SIZE, stringify=str, paramstyle="qmark",
+                 column_type="TEXT", convert=None, **options):
+        super(DbApiWriter, self).__init__(table, columns, batch_size, convert)
+        self.connection = connection
+        self.table = table
+        self.stringify = stringify
+        self.named_parameters = paramstyle in ("named", "pyformat")
+        self.create_table(column_type)
+        self.insert_statement = "INSERT INTO {} ({}) VALUES ({})".format(
+            quote_identifier(table), ", ".join(quote_identifier(c) for c in self.columns), self._placeholders(paramstyle))
+
+    def _placeholders(self, paramstyle):
+        if paramstyle == "qmark":
+            return ", ".join("?" for _ in self.columns)
+        if paramstyle == "format":
+            return ", ".join("%s" for _ in self.columns)
+        if paramstyle == "numeric":
+            return ", ".join(":%d" % (i + 1) for i in range(len(self.columns)))
+        # named parameters use the index of the column: columns are not
+        # always valid parameter names
+        if paramstyle == "named":
+            return ", ".join(":c%d" % i for i in range(len(self.columns)))
+        if paramstyle == "pyformat":
+            return ", ".join("%%(c%d)s" % i for i in range(len(self.columns)))
+        raise ValueError("Unknown paramstyle '{}'".format(paramstyle))
+
+    def create_table(self, column_type="TEXT"):
+        definitions = ", ".join(quote_identifier(c) + (" " + column_type if column_type else "") for c in self.columns)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(quote_identifier(self.table), definitions))
+        finally:
+            cursor.close()
+        self.connection.commit()
+
+    def _parameters(self, row):
+        stringify = self.stringify
+        convert = self.convert
+        if convert:
+            # missing values stay NULL
+            values = [convert(row[column]) if column in row else None for column in self.columns]
+        else:
+            values = [row.get(column) for column in self.columns]
+        values = [stringify(v) if isinstance(v, (list, dict, tuple, set)) else v for v in values]
+        if self.named_parameters:
+            return {"c%d" % i: v for i, v in enumerate(values)}
+        return values
+
+    def write_batch(self, rows):
+        """Insert the rows in one transaction"""
+        parameters = [self._parameters(row) for row in rows]
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(self.insert_statement, parameters)
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+
+    @property
+    def bytes_written(self):
+        return None
+
+
+class SqliteWriter(DbApiWriter):
+    """Inserts rows in a table of a SQLite database file.
+    Columns are untyped: values keep their type when not written as strings.
+    """
+
+    def __init__(self, filename, columns, table=None, **options):
+        table = table or os.path.splitext(os.path.basename(filename))[0]
+        # several processes may write in the same database
+        import sqlite3
+        connection = sqlite3.connect(filename, timeout=60)
+        try:
+            super(SqliteWriter, self).__init__(connection, table, columns, paramstyle="qmark", column_type=None, **options)
+        except Exception:
+            connection.close()
+            raise
+        self.filename = filename
+
+    def close(self):
+        try:
+            super(SqliteWriter, self).close()
+        finally:
+            self.connection.close()
+
+    @property
+    def bytes_written(self):
+        return RowWriter.bytes_written.fget(self)
+
+
+FORMATS = {
+    "csv": CsvWriter,
+    "parquet": ParquetWriter,
+    "arrow": ArrowIpcWriter,
+    "feather": FeatherWriter,
+    "sqlite": SqliteWriter,
+}
+
+EXTENSIONS = {
+    ".csv": "csv",
+    ".tsv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".ipc": "arrow",
+    ".feather": "feather",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+}
+
+
+def infer_format(filename, default="csv"):
+    """Output format according to the extension of the file (ignoring a
+    compression extension)
+    """
+    ext = os.path.splitext(jsonio.strip_compression_extension(filename))[1].lower()
+    return EXTENSIONS.get(ext, default)
+
+
+def extension(output_format):
+    return ".db" if output_format == "sqlite" else "." + output_format
+
+
+def get_writer(output_format, filename, columns, **options):
+    """Open a writer of the given format ('csv', 'parquet', 'arrow',
+    'feather' or 'sqlite'). Options a format does not use are ignored.
+    """
+    try:
+        writer_class = FORMATS[output_format]
+    except KeyError:
+        raise ValueError("Unknown output format '{}'. Use one of: {}".format(output_format, ", ".join(FORMATS)))
+    return writer_class(filename, columns, **options)